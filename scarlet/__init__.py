@@ -4,5 +4,7 @@ from .constraint import *
 from .component import *
 from .source import *
 from .blend import Blend
+from .batch import run_blends, run_tiles
 from .config import Config
 from . import psf_match
+from . import stopping
@@ -0,0 +1,448 @@
+from __future__ import print_function, division
+import multiprocessing
+
+import numpy as np
+
+from .config import Config
+from .component import ComponentTree
+from .source import ExtendedSource
+from .blend import Blend
+
+import logging
+logger = logging.getLogger("scarlet.batch")
+
+
+def _build_sources(img, peaks, bg_rms, source_class, source_kwargs, config):
+    """Build a source at each peak, skipping the sources that fail
+
+    See `run_blends` for a description of the parameters.
+
+    Returns
+    -------
+    sources: list
+        The sources that were built.
+    built: list
+        Index in `peaks` of each source in `sources`.
+    errors: list
+        Exception raised while building the source at each peak, or `None`.
+    """
+    sources = []
+    built = []
+    errors = [None] * len(peaks)
+    for i, peak in enumerate(peaks):
+        try:
+            sources.append(source_class(peak, img, bg_rms, config=config, **source_kwargs))
+            built.append(i)
+        except Exception as error:
+            logger.info("skipping source {0} at {1}: {2}: {3}".format(i, tuple(peak), type(error).__name__, error))
+            errors[i] = error
+    return sources, built, errors
+
+
+def _fit_blend(img, sources, weights, bg_rms, config, steps, e_rel):
+    """Fit the blend of a single footprint
+
+    See `run_blends` for a description of the parameters.
+
+    Returns
+    -------
+    blend: `~scarlet.blend.Blend`
+        The fitted blend.
+    """
+    blend = Blend(sources).set_data(img, weights=weights, bg_rms=bg_rms, config=config)
+    blend.fit(steps, e_rel=e_rel)
+    return blend
+
+
+def _run_blend(args):
+    """Build and fit the blend of a single footprint
+
+    This is the function executed by the worker processes of `run_blends`,
+    so it has to be a module level function that takes a single argument.
+
+    Parameters
+    ----------
+    args: tuple
+        `(index, footprint, source_class, source_kwargs, config, steps, e_rel)`,
+        see `run_blends` for a description.
+
+    Returns
+    -------
+    model: `~numpy.array`
+        (Components, Bands, Height, Width) model of each component of the
+        sources that were built, or `None` if the blend failed.
+    converged: `~numpy.array`
+        (Components, 2) array with the convergence flags for the SED and
+        morphology of each component, or `None` if the blend failed.
+    errors: list
+        The exception raised while building the source at each peak,
+        or while fitting the blend, or `None`.
+    """
+    index, footprint, source_class, source_kwargs, config, steps, e_rel = args
+    img, peaks, weights, bg_rms = footprint
+    sources, built, errors = _build_sources(img, peaks, bg_rms, source_class, source_kwargs, config)
+    if len(sources) == 0:
+        logger.warning("blend {0} failed: none of its {1} sources could be built".format(index, len(peaks)))
+        return None, None, errors
+    try:
+        blend = _fit_blend(img, sources, weights, bg_rms, config, steps, e_rel)
+        return blend.get_model(combine=False), np.array(blend.converged), errors
+    except Exception as error:
+        logger.warning("blend {0} failed with {1}: {2}".format(index, type(error).__name__, error))
+        return None, None, [error] * len(peaks)
+
+
+def run_blends(footprints, processes=None, source_class=ExtendedSource, source_kwargs=None,
+               config=None, steps=200, e_rel=1e-2):
+    """Deblend a list of footprints in parallel
+
+    For every footprint a source is created at each peak, the sources are
+    combined into a `~scarlet.blend.Blend` and the blend is fit.
+    The blends are independent of each other, so they are fit in a pool of
+    worker processes.
+    A source that cannot be built (for example because it raises a
+    `~scarlet.source.SourceInitError`) is skipped and the remaining sources
+    of its footprint are fit without it. A blend that raises an exception
+    does not stop the other blends. In both cases the exceptions are
+    returned in `errors`.
+
+    Parameters
+    ----------
+    footprints: list
+        List of `(img, peaks, weights, bg_rms)` tuples for each footprint,
+        where `img` is the (Bands, Height, Width) image cutout,
+        `peaks` is a list of (y,x) positions of the sources in `img`,
+        `weights` is either `None` or a (Bands, Height, Width) array of weights
+        and `bg_rms` is the background RMS in each band
+        (see `~scarlet.blend.Blend.set_data`).
+    processes: int, default=`None`
+        Number of worker processes. If `processes` is `None`, the number of
+        CPUs is used. If `processes` is `1`, the blends are fit serially in
+        the current process.
+    source_class: class, default=`~scarlet.source.ExtendedSource`
+        Class used to create the sources. It is initialized with
+        `source_class(peak, img, bg_rms, config=config, **source_kwargs)`.
+    source_kwargs: dict, default=`None`
+        Additional keyword arguments for `source_class`, e.g. `psf`.
+    config: `~scarlet.config.Config`, default=`None`
+        Configuration used for all sources and blends.
+    steps: int
+        Maximum number of iterations of `~scarlet.blend.Blend.fit`.
+    e_rel: float
+        Relative error for convergence of `~scarlet.blend.Blend.fit`.
+
+    Returns
+    -------
+    models: list
+        (Components, Bands, Height, Width) model of each component of the sources
+        that were built, for each footprint in the same order as `footprints`
+        (`None` for blends that failed).
+    converged: list
+        (Components, 2) convergence flags of the SED and morphology of each component,
+        for each footprint (`None` for blends that failed).
+    errors: list
+        For each footprint, the list of exceptions raised by the source at
+        each peak (`None` for sources that were deblended successfully).
+        If the fit of a blend failed, its exception is used for all of its peaks.
+    """
+    if config is None:
+        config = Config()
+    if source_kwargs is None:
+        source_kwargs = {}
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    args = [(index, footprint, source_class, source_kwargs, config, steps, e_rel)
+            for index, footprint in enumerate(footprints)]
+    if processes == 1 or len(args) <= 1:
+        results = [_run_blend(arg) for arg in args]
+    else:
+        pool = multiprocessing.Pool(min(processes, len(args)))
+        try:
+            # map keeps the order of the footprints
+            results = pool.map(_run_blend, args, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    if len(results) == 0:
+        return [], [], []
+    models, converged, errors = [list(r) for r in zip(*results)]
+    return models, converged, errors
+
+
+def get_tiles(shape, tile_size, overlap):
+    """Split an image into overlapping tiles
+
+    The image is divided into a grid of non-overlapping cores with
+    (at most) `tile_size` pixels on each side, and every tile is the core
+    extended by `overlap` pixels in each direction (truncated at the
+    edges of the image).
+
+    Parameters
+    ----------
+    shape: tuple
+        (Height, Width) of the image.
+    tile_size: int
+        Size of the core of each tile.
+    overlap: int
+        Number of pixels the tiles extend beyond their core.
+
+    Returns
+    -------
+    tiles: list
+        List of `(core, tile)` tuples, where both `core` and `tile`
+        are `(bottom, top, left, right)` pixel boundaries in the image.
+    """
+    Ny, Nx = shape
+    tiles = []
+    for bottom in range(0, Ny, tile_size):
+        for left in range(0, Nx, tile_size):
+            core = (bottom, min(bottom + tile_size, Ny), left, min(left + tile_size, Nx))
+            tile = (max(core[0] - overlap, 0), min(core[1] + overlap, Ny),
+                    max(core[2] - overlap, 0), min(core[3] + overlap, Nx))
+            tiles.append((core, tile))
+    return tiles
+
+
+def estimate_bg_rms(img, sigma=3, iterations=5):
+    """Estimate the background RMS in each band of an image
+
+    The RMS is estimated from the median absolute deviation (MAD) of the
+    pixels, after iteratively clipping the pixels more than `sigma` times
+    the RMS away from the median, which removes most of the source flux.
+
+    Parameters
+    ----------
+    img: `~numpy.array`
+        (Bands, Height, Width) image.
+    sigma: float
+        Clipping threshold in units of the RMS.
+    iterations: int
+        Maximum number of clipping iterations.
+
+    Returns
+    -------
+    bg_rms: `~numpy.array`
+        Background RMS in each band.
+    """
+    bg_rms = np.zeros(len(img))
+    for b, band in enumerate(img):
+        pixels = np.asarray(band).reshape(-1)
+        pixels = pixels[np.isfinite(pixels)]
+        for it in range(iterations):
+            median = np.median(pixels)
+            deviation = np.abs(pixels - median)
+            # scale the MAD to the standard deviation of a normal distribution
+            bg_rms[b] = 1.4826 * np.median(deviation)
+            clipped = pixels[deviation <= sigma * bg_rms[b]]
+            if len(clipped) == len(pixels) or len(clipped) == 0:
+                break
+            pixels = clipped
+    return bg_rms
+
+
+def _run_tile(args):
+    """Fit all sources in a tile and combine the models of the owned sources
+
+    This is the function executed by the worker processes of `run_tiles`.
+
+    Parameters
+    ----------
+    args: tuple
+        `(index, footprint, owned, source_class, source_kwargs, config, steps, e_rel)`
+        where `footprint` is the `(img, peaks, weights, bg_rms)` of the tile and
+        `owned` is the index in `peaks` of each source owned by the tile.
+
+    Returns
+    -------
+    model: `~numpy.array`
+        (Bands, Height, Width) sum of the models of all owned sources,
+        or `None` if the blend failed.
+    converged: `~numpy.array`
+        (Owned sources, 2) array with the convergence flags of the owned sources,
+        or `None` if the blend failed.
+    errors: list
+        The exception raised while building each owned source, or while
+        fitting the blend, or `None`.
+    """
+    index, footprint, owned, source_class, source_kwargs, config, steps, e_rel = args
+    img, peaks, weights, bg_rms = footprint
+    if bg_rms is None:
+        bg_rms = estimate_bg_rms(img)
+    sources, built, errors = _build_sources(img, peaks, bg_rms, source_class, source_kwargs, config)
+    if len(sources) == 0:
+        logger.warning("tile {0} failed: none of its {1} sources could be built".format(index, len(peaks)))
+        return None, None, [errors[i] for i in owned]
+    try:
+        blend = _fit_blend(img, sources, weights, bg_rms, config, steps, e_rel)
+        model = np.zeros(img.shape, dtype=config.dtype)
+        # owned sources that could not be built are not converged
+        converged = np.zeros((len(owned), 2), dtype=bool)
+        node_of = dict((i, n) for n, i in enumerate(built))
+        index_of = dict((id(c), k) for k, c in enumerate(blend.components))
+        for n, i in enumerate(owned):
+            if i not in node_of:
+                continue
+            node = blend.nodes[node_of[i]]
+            components = node.components if isinstance(node, ComponentTree) else (node,)
+            ks = [index_of[id(c)] for c in components]
+            for k in ks:
+                _model, bb = blend._get_box_model(k)
+                model[bb] += _model
+            converged[n] = np.all([blend.converged[k] for k in ks], axis=0)
+        return model, converged, [errors[i] for i in owned]
+    except Exception as error:
+        logger.warning("tile {0} failed with {1}: {2}".format(index, type(error).__name__, error))
+        return None, None, [error] * len(owned)
+
+
+def run_tiles(img, peaks, weights=None, bg_rms=None, tile_size=500, overlap=None, output=None,
+              processes=None, source_class=ExtendedSource, source_kwargs=None, config=None,
+              steps=200, e_rel=1e-2):
+    """Deblend a large image in tiles, into a full-frame in-memory array unless `output` is a memmap
+
+    The image is split into overlapping tiles (see `get_tiles`) and every
+    source is assigned to the tile whose core contains its peak.
+    Each tile is fit independently (in parallel if `processes > 1`) with
+    all of the sources in the tile, including the sources owned by
+    neighboring tiles that lie in the overlap region, so that their flux is
+    not assigned to the owned sources.
+
+    Only the models of the owned sources are added to the full-frame `output`,
+    so every source contributes exactly once. In the overlap regions
+    `output` is the sum of the models of the owned sources from all tiles
+    that contain them, where each model is truncated at the edge of its tile.
+    The default `overlap` of half the largest `config.source_sizes`
+    ensures that the frame of a source in the core fits into its tile.
+
+    The tiles are read from `img` (and `weights`) one batch of `processes`
+    tiles at a time. Only with a memory mapped `img` (e.g. from
+    `numpy.load(filename, mmap_mode='r')`) *and* `output` (e.g. from
+    `numpy.lib.format.open_memmap`) is the memory consumption bounded by the
+    tile size. With the default `output=None` a full-frame array is
+    allocated in memory, so the memory consumption grows with the image size.
+
+    A source that cannot be built (for example because it raises a
+    `~scarlet.source.SourceInitError`) is skipped, and the other sources
+    in its tile are fit without it.
+
+    Parameters
+    ----------
+    img: array-like
+        (Bands, Height, Width) image, for example a `numpy.memmap`.
+    peaks: array-like
+        List of (y,x) positions of the sources in `img`.
+    weights: array-like, default=`None`
+        (Bands, Height, Width) weights of `img`, see `~scarlet.blend.Blend.set_data`.
+    bg_rms: array-like, default=`None`
+        Background RMS in each band, see `~scarlet.blend.Blend.set_data`.
+        If `bg_rms` is `None`, it is estimated in each tile with `estimate_bg_rms`.
+    tile_size: int
+        Size of the core of each tile.
+    overlap: int, default=`None`
+        Number of pixels each tile extends beyond its core.
+        If `overlap` is `None`, half of the largest `config.source_sizes` is used.
+    output: array-like, default=`None`
+        (Bands, Height, Width) array the models are added to, for example a
+        `numpy.memmap`. If `output` is `None`, a new array of type
+        `config.dtype` with the shape of `img` is allocated in memory.
+    processes: int, default=`None`
+        Number of worker processes. If `processes` is `None`, the number of
+        CPUs is used. If `processes` is `1`, the tiles are fit serially in
+        the current process.
+    source_class: class, default=`~scarlet.source.ExtendedSource`
+        Class used to create the sources. It is initialized with
+        `source_class(peak, img, bg_rms, config=config, **source_kwargs)`.
+    source_kwargs: dict, default=`None`
+        Additional keyword arguments for `source_class`, e.g. `psf`.
+    config: `~scarlet.config.Config`, default=`None`
+        Configuration used for all sources and blends.
+    steps: int
+        Maximum number of iterations of `~scarlet.blend.Blend.fit` for each tile.
+    e_rel: float
+        Relative error for convergence of `~scarlet.blend.Blend.fit`.
+
+    Returns
+    -------
+    output: array-like
+        (Bands, Height, Width) model of the full image.
+    converged: `~numpy.array`
+        (Sources, 2) convergence flags of the SED and morphology of each source in `peaks`
+        (all `False` for sources that could not be built and for sources in tiles that failed).
+    errors: list
+        Exception raised while building each source in `peaks`, or while
+        fitting its tile, or `None`.
+
+    Raises
+    ------
+    RuntimeError
+        If the fit of every tile failed.
+    """
+    if config is None:
+        config = Config()
+    if source_kwargs is None:
+        source_kwargs = {}
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if overlap is None:
+        overlap = config.source_sizes[-1] // 2
+    if output is None:
+        output = np.zeros(img.shape, dtype=config.dtype)
+    peaks = np.array(peaks)
+    peaks_int = np.round(peaks).astype(int)
+
+    # assign every source to the tile that contains its peak in the core
+    tasks = []
+    for index, (core, tile) in enumerate(get_tiles(img.shape[1:], tile_size, overlap)):
+        in_core = ((peaks_int[:,0] >= core[0]) & (peaks_int[:,0] < core[1]) &
+                   (peaks_int[:,1] >= core[2]) & (peaks_int[:,1] < core[3]))
+        if not np.any(in_core):
+            continue
+        in_tile = ((peaks_int[:,0] >= tile[0]) & (peaks_int[:,0] < tile[1]) &
+                   (peaks_int[:,1] >= tile[2]) & (peaks_int[:,1] < tile[3]))
+        sources = np.flatnonzero(in_tile)
+        owned = np.flatnonzero(in_core[sources])
+        tasks.append((index, tile, sources, owned))
+
+    converged = np.zeros((len(peaks), 2), dtype=bool)
+    errors = [None] * len(peaks)
+    # error of the first owned source of every failed tile
+    failed = []
+    pool = None
+    if processes > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(processes, len(tasks)))
+    try:
+        # only read `processes` tiles at once to limit the memory usage
+        batch_size = processes if pool is not None else 1
+        for n in range(0, len(tasks), batch_size):
+            args = []
+            for index, tile, sources, owned in tasks[n:n+batch_size]:
+                tile_slice = (slice(None), slice(tile[0], tile[1]), slice(tile[2], tile[3]))
+                _weights = None if weights is None else np.array(weights[tile_slice])
+                footprint = (np.array(img[tile_slice]), peaks[sources] - (tile[0], tile[2]), _weights, bg_rms)
+                args.append((index, footprint, owned, source_class, source_kwargs, config, steps, e_rel))
+            if pool is not None:
+                results = pool.map(_run_tile, args, chunksize=1)
+            else:
+                results = [_run_tile(arg) for arg in args]
+
+            # stitch the models of the owned sources into the full image
+            for (index, tile, sources, owned), (model, _converged, _errors) in zip(tasks[n:n+batch_size], results):
+                owner = sources[owned]
+                for i, error in zip(owner, _errors):
+                    errors[i] = error
+                if model is None:
+                    failed.append(_errors[0])
+                    continue
+                tile_slice = (slice(None), slice(tile[0], tile[1]), slice(tile[2], tile[3]))
+                output[tile_slice] += model
+                converged[owner] = _converged
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if len(tasks) > 0 and len(failed) == len(tasks):
+        raise RuntimeError("All {0} tiles failed, the first with {1}: {2}".format(
+                           len(tasks), type(failed[0]).__name__, failed[0]))
+    return output, converged, errors
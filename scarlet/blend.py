@@ -1,10 +1,16 @@
 from __future__ import print_function, division
+import os
 import numpy as np
 from functools import partial
+from timeit import default_timer as timer
 
 import proxmin
 from .config import Config
+from .operator import prox_batch
 from .source import ComponentTree
+from .stopping import StoppingPolicy
+from .storage import ParameterStore
+from .transformation import apply_filters
 
 import logging
 logger = logging.getLogger("scarlet.blend")
@@ -19,9 +25,170 @@ class ScarletRestartException(Exception):
     when a breaking change is made to one of the components so
     that `Blend.fit` can catch the exception and restart
     the bSDMM algorithm from the last iteration.
+    The block-PGM algorithm of `Blend._bpgm` handles resizing in place
+    and is not restarted.
     """
     pass
 
+class ScarletStopException(Exception):
+    """Stop the fit
+
+    Thrown when a `~scarlet.stopping.StoppingPolicy` stops a fit with
+    `proxmin.algorithms.bsdmm`, which cannot be stopped otherwise.
+    """
+    pass
+
+class _PhaseTimer(object):
+    """Context manager that adds the time spent in its block to a phase of `Blend.timings`
+    """
+    def __init__(self, blend, phase):
+        self.blend = blend
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = timer()
+
+    def __exit__(self, *args):
+        self.blend._add_timing(self.phase, timer() - self.start)
+
+
+class _NullTimer(object):
+    """Context manager that does nothing, used when profiling is disabled
+    """
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+_null_timer = _NullTimer()
+
+
+def power_iteration(matvec, x0, e_rel=1e-3, max_iter=100):
+    """Largest eigenvalue of a symmetric positive semi-definite operator
+
+    Parameters
+    ----------
+    matvec: function
+        Function that applies the operator to a vector.
+    x0: `~numpy.array`
+        Initial guess of the dominant eigenvector, e.g. the eigenvector
+        of a previous call for a similar operator.
+    e_rel: float
+        Relative change of the eigenvalue between two iterations
+        below which the iteration is stopped.
+    max_iter: int
+        Maximum number of iterations.
+
+    Returns
+    -------
+    value: float
+        Estimate of the largest eigenvalue (a lower bound).
+    x: `~numpy.array`
+        Normalized estimate of the dominant eigenvector.
+    """
+    norm = np.sqrt(np.sum(x0**2))
+    if norm == 0:
+        x0 = np.ones_like(x0)
+        norm = np.sqrt(x0.size)
+    x = x0 / norm
+    value = 0.
+    for it in range(max_iter):
+        y = matvec(x)
+        # Rayleigh quotient of the unit vector x,
+        # converges twice as fast as |Mx| for symmetric M
+        _value = np.dot(x, y)
+        norm = np.sqrt(np.sum(y**2))
+        if norm == 0:
+            return 0., x
+        x = y / norm
+        if abs(_value - value) <= e_rel * _value:
+            return _value, x
+        value = _value
+    logger.debug("power iteration did not converge in {0} iterations".format(max_iter))
+    return value, x
+
+
+class History(object):
+    """Record of the fit of a `~scarlet.blend.Blend` in every iteration
+
+    The per-iteration values are stored in arrays that are allocated for
+    all iterations of a call to `~scarlet.blend.Blend.fit` in advance.
+
+    Attributes
+    ----------
+    it: `~numpy.array`
+        Iteration number (`Blend.it` at the end of the iteration).
+    chi2: `~numpy.array`
+        Weighted chi^2 of the model at the beginning of each iteration,
+        with the `weights` passed to `~scarlet.blend.Blend.set_data`.
+    steps: `~numpy.array`
+        (iterations, 2) array of the step sizes of the SEDs and morphologies.
+    changes: `~numpy.array`
+        (iterations, K, 2) array of the relative changes `|X - X_prev|/|X|`
+        of the SED and morphology of each component.
+    events: list
+        List of tuples `(it, k, event, value)` for every `"recenter"`
+        (`value` is the shift `(dy, dx)`) and `"resize"` (`value` is the new
+        shape `(Ny, Nx)`) of component `k`.
+    """
+    def __init__(self, K):
+        """Initialize the history
+
+        Parameters
+        ----------
+        K: int
+            Number of components.
+        """
+        self.K = K
+        self.size = 0
+        self._it = np.zeros(0, dtype=int)
+        self._chi2 = np.zeros(0)
+        self._steps = np.zeros((0, 2))
+        self._changes = np.zeros((0, K, 2))
+        self.events = []
+
+    def __len__(self):
+        return self.size
+
+    def reserve(self, size):
+        """Allocate the arrays for at least `size` iterations
+        """
+        if size > len(self._it):
+            n = size - len(self._it)
+            self._it = np.concatenate([self._it, np.zeros(n, dtype=int)])
+            self._chi2 = np.concatenate([self._chi2, np.full(n, np.nan)])
+            self._steps = np.concatenate([self._steps, np.full((n, 2), np.nan)])
+            self._changes = np.concatenate([self._changes, np.full((n, self.K, 2), np.nan)])
+
+    def append(self, it, chi2, steps, changes):
+        """Record an iteration
+        """
+        if self.size == len(self._it):
+            self.reserve(max(2*self.size, 16))
+        self._it[self.size] = it
+        self._chi2[self.size] = chi2
+        self._steps[self.size] = steps
+        self._changes[self.size] = changes
+        self.size += 1
+
+    @property
+    def it(self):
+        return self._it[:self.size]
+
+    @property
+    def chi2(self):
+        return self._chi2[:self.size]
+
+    @property
+    def steps(self):
+        return self._steps[:self.size]
+
+    @property
+    def changes(self):
+        return self._changes[:self.size]
+
+
 class Blend(ComponentTree):
     """The blended scene.
 
@@ -46,6 +213,18 @@ class Blend(ComponentTree):
         self.use_psf = any(have_psf)
         assert any(have_psf) == all(have_psf)
 
+        # profiling is disabled by default (see `set_profiling`)
+        self.timings = None
+        self._callback = None
+        # history is disabled by default (see `set_history`)
+        self.history = None
+        self._stopping = []
+        # dominant eigenvectors of the last Lipschitz calculation of A and S
+        self._lipschitz_vectors = [None, None]
+        self._reset_frozen()
+        # contiguous SEDs and morphologies (see `Config.parameter_store`)
+        self._store = None
+
     def set_data(self, img, weights=None, bg_rms=None, config=None):
         """Set data and fitting parameters.
 
@@ -73,7 +252,7 @@ class Blend(ComponentTree):
             config = Config()
         self.config = config
 
-        self._img = img
+        self._img = np.asarray(img, dtype=self.config.dtype)
         B, Ny, Nx = img.shape
         max_size = self.config.source_sizes[-1]
         if max(Ny,Nx) > max_size:
@@ -87,7 +266,216 @@ class Blend(ComponentTree):
         self._set_weights(weights)
         return self
 
-    def fit(self, steps=200, e_rel=1e-2):
+    def set_profiling(self, enabled=True, callback=None):
+        """Enable or disable the profiling of `fit`
+
+        When profiling is enabled, the wall-clock time and the number of calls
+        of each phase of the fit are accumulated in `timings`:
+
+        - `model`: building the model of all components (`_compute_model`)
+        - `grad_sed`, `grad_morph`: gradients of the likelihood
+        - `prox_sed`, `prox_morph`: proximal operators of the constraints
+        - `lipschitz`: step sizes from the Lipschitz constants (`_one_over_lipschitz`)
+        - `recenter`: updating the centers of the components (`_recenter_components`)
+        - `resize`: updating the frames of the components (`_resize_components`)
+        - `iteration`: the entire iteration
+
+        Parameters
+        ----------
+        enabled: bool, default=`True`
+            Whether to accumulate the timings. Enabling profiling resets `timings`.
+        callback: function, default=`None`
+            Function `callback(blend, loss, timings)` that is called after
+            every iteration with the blend, the negative log-likelihood `loss`
+            (half of the chi^2 with the `weights` passed to `set_data`) of the
+            model at the beginning of the iteration and a dictionary `timings`
+            with the seconds spent in each phase during the iteration
+            (empty if `enabled` is `False`).
+
+        Returns
+        -------
+        self: `~scarlet.blend.Blend`
+        """
+        self.timings = {} if enabled else None
+        self._iteration_timings = {}
+        self._callback = callback
+        return self
+
+    def set_history(self, enabled=True):
+        """Enable or disable recording the `history` of the fit
+
+        When enabled, `history` is a `~scarlet.blend.History` that records
+        the weighted chi^2, the step sizes and the relative changes of the SED
+        and morphology of each component in every iteration, as well as every
+        recentering and resizing of a component.
+        This requires an additional pass over the image and over every
+        component in each iteration.
+
+        Parameters
+        ----------
+        enabled: bool, default=`True`
+            Whether to record the history. Enabling the history
+            discards the previous `history`.
+
+        Returns
+        -------
+        self: `~scarlet.blend.Blend`
+        """
+        if enabled:
+            self.history = History(self.K)
+        else:
+            self.history = None
+        return self
+
+    def _record_change(self, j, X_prev, X):
+        """Store the relative change of `X` for the `history` and the stopping policies
+        """
+        norm = proxmin.utils.l2sq(X)
+        self._changes[j%self.K, j//self.K] = np.sqrt(proxmin.utils.l2sq(X - X_prev) / norm) if norm > 0 else 0
+
+    def _timer(self, phase):
+        """Context manager to time `phase` if profiling is enabled
+        """
+        if self.timings is None:
+            return _null_timer
+        return _PhaseTimer(self, phase)
+
+    def _add_timing(self, phase, seconds):
+        """Add a call of `phase` that took `seconds` to `timings`
+        """
+        try:
+            timing = self.timings[phase]
+        except KeyError:
+            timing = self.timings[phase] = [0, 0.]
+        timing[0] += 1
+        timing[1] += seconds
+        self._iteration_timings[phase] = self._iteration_timings.get(phase, 0.) + seconds
+
+    def _get_chi2(self):
+        """Weighted chi^2 of the model at the beginning of the current iteration
+
+        The chi^2 uses the `weights` passed to `set_data` (or unit weights),
+        not the normalized weights of the SED and morphology updates.
+        """
+        if self._chi2_it != self._model_it:
+            self._chi2 = float(np.sum(self._data_weights * (self._model - self._img)**2))
+            self._chi2_it = self._model_it
+        return self._chi2
+
+    def _end_iteration(self):
+        """Record the time of the iteration, call the profiling callback and the stopping policies
+
+        If a stopping policy stops the fit, `_stopped` is set, and with
+        `proxmin.algorithms.bsdmm` a `ScarletStopException` is raised.
+        """
+        if self.timings is None and self._callback is None and not self._track_changes:
+            return
+        now = timer()
+        if self.timings is not None:
+            self._add_timing("iteration", now - self._iteration_start)
+        if self.history is not None:
+            self.history.append(self.it, self._get_chi2(), self._stepAS, self._changes)
+        if self._callback is not None:
+            self._callback(self, 0.5 * self._get_chi2(), self._iteration_timings)
+        self._iteration_timings = {}
+        stop = False
+        for policy in self._stopping:
+            # call every policy, even if the fit is stopped by another one
+            stop = policy(self, self._changes) or stop
+        self._iteration_start = timer()
+        if stop:
+            self._stopped = True
+            if self._restart_on_resize:
+                raise ScarletStopException()
+
+    def _reset_frozen(self):
+        """Unfreeze all components
+        """
+        self.frozen = np.zeros(self.K, dtype=bool)
+        self._unfreeze_thresh = {}
+        self._frozen_diff = {}
+
+    def freeze(self, k, unfreeze_thresh=None):
+        """Stop updating component `k` until the end of the current fit
+
+        The component contributes to the model, but its SED, morphology,
+        center and frame are not updated, so that its gradients and proximal
+        operators are not computed anymore, and its model is not rebuilt
+        (see `_compute_model`).
+
+        Parameters
+        ----------
+        k: int
+            Index of the component.
+        unfreeze_thresh: float, default=`None`
+            If `unfreeze_thresh` is not `None`, the component is unfrozen
+            when the weighted residuals in its bounding box change by more than
+            `unfreeze_thresh` (relative to the residuals when it was frozen),
+            e.g. because the neighboring components changed.
+        """
+        if not self.frozen[k]:
+            logger.debug("freezing component {0} at it {1}".format(self.components[k].coord, self.it))
+            self.frozen[k] = True
+        if unfreeze_thresh is not None:
+            self._unfreeze_thresh[k] = unfreeze_thresh
+
+    def unfreeze(self, k):
+        """Update component `k` again after it was frozen with `freeze`
+
+        Parameters
+        ----------
+        k: int
+            Index of the component.
+        """
+        if not self.frozen[k]:
+            return
+        logger.debug("unfreezing component {0} at it {1}".format(self.components[k].coord, self.it))
+        self.frozen[k] = False
+        self._unfreeze_thresh.pop(k, None)
+        self._frozen_diff.pop(k, None)
+
+    def _check_frozen(self):
+        """Unfreeze components when the residuals in their bounding boxes changed
+
+        See `freeze`.
+        """
+        for k, thresh in list(self._unfreeze_thresh.items()):
+            diff = self._diff[self._bbs[k]]
+            try:
+                diff0 = self._frozen_diff[k]
+            except KeyError:
+                # residuals when the component was frozen
+                self._frozen_diff[k] = diff.copy()
+                continue
+            norm = proxmin.utils.l2sq(diff0)
+            if proxmin.utils.l2sq(diff - diff0) > thresh**2 * norm:
+                self.unfreeze(k)
+
+    def timing_report(self):
+        """Summary of the timings of the fit
+
+        Returns
+        -------
+        report: str
+            Table with the number of calls, the total and mean time
+            and the fraction of the total time of every phase in `timings`.
+        """
+        if self.timings is None:
+            raise RuntimeError("profiling not enabled: call set_profiling() before fit()!")
+        total = self.timings.get("iteration", [0, 0.])[1]
+        lines = ["{0:<12} {1:>8} {2:>10} {3:>12} {4:>7}".format("phase", "calls", "total [s]", "mean [ms]", "%")]
+        phases = sorted([phase for phase in self.timings if phase != "iteration"],
+                        key=lambda phase: -self.timings[phase][1])
+        for phase in phases + ["iteration"]:
+            if phase not in self.timings:
+                continue
+            calls, seconds = self.timings[phase]
+            fraction = 100 * seconds / total if total > 0 else np.nan
+            lines.append("{0:<12} {1:>8d} {2:>10.3f} {3:>12.3f} {4:>7.1f}".format(
+                phase, calls, seconds, 1000 * seconds / calls, fraction))
+        return "\n".join(lines)
+
+    def fit(self, steps=200, e_rel=1e-2, checkpoint_every=None, checkpoint_path=None, stopping=None):
         """Fit the model for each source to the data
 
         Parameters
@@ -97,6 +485,24 @@ class Blend(ComponentTree):
         e_rel: float, default=`None`
             Relative error for convergence. If `e_rel` is `None`, the default
             `~scarlet.blend.Blend.e_rel` is used for convergence checks
+        checkpoint_every: int, default=`None`
+            Number of iterations between checkpoints.
+            If `checkpoint_every` is not `None`, the state of the fit is
+            saved to `checkpoint_path` with `save_state` every
+            `checkpoint_every` iterations, so that a fit resumed with
+            `load_state` is identical to a fit that was never interrupted.
+            When the constraints require `proxmin.algorithms.bsdmm`, the dual
+            variables of the optimizer cannot be saved, so the optimizer is
+            restarted at every checkpoint. A checkpointed bSDMM fit therefore
+            follows a different path than the same fit without checkpoints,
+            and it has to be resumed with the same `checkpoint_every` to be
+            identical to the uninterrupted checkpointed fit.
+        checkpoint_path: str, default=`None`
+            File the checkpoints are written to.
+        stopping: `~scarlet.stopping.StoppingPolicy` or list thereof, default=`None`
+            Policies that are called after every iteration to stop the fit
+            early or to freeze components (see `freeze`).
+            Components are unfrozen at the beginning of every call to `fit`.
 
         Returns
         -------
@@ -110,7 +516,34 @@ class Blend(ComponentTree):
             self._img
         except AttributeError:
             raise RuntimeError("img not set: call set_data() before fit()!")
+        if checkpoint_every is not None and checkpoint_path is None:
+            raise ValueError("checkpoint_path is required to use checkpoint_every")
+
+        if stopping is None:
+            stopping = []
+        elif isinstance(stopping, StoppingPolicy):
+            stopping = [stopping]
+        self._stopping = stopping
+        self._reset_frozen()
+        # relative changes of all SEDs and morphologies in the current iteration
+        self._track_changes = self.history is not None or len(self._stopping) > 0
+        self._changes = np.zeros((self.K, 2))
+        self._chi2_it = None
+        self._stopped = False
+        for policy in self._stopping:
+            policy.reset(self)
+
+        try:
+            self._fit(steps, e_rel, checkpoint_every=checkpoint_every, checkpoint_path=checkpoint_path)
+        except ScarletStopException:
+            pass
+        return self
 
+    def _fit(self, steps, e_rel, checkpoint_every=None, checkpoint_path=None):
+        """Run the optimizer (see `fit`)
+
+        When the bSDMM optimizer has to be restarted, `_fit` is called recursively.
+        """
         try:
             self.it # test of this is first time fit is called
         except AttributeError:
@@ -142,6 +575,8 @@ class Blend(ComponentTree):
         self.e_rel = e_rel
         self._set_error_limits()
 
+        self._set_store()
+
         # collect all SEDs and morphologies, plus associated errors
         XA = []
         XS = []
@@ -150,6 +585,10 @@ class Blend(ComponentTree):
             XS.append(self.components[k].morph)
         X = XA + XS
 
+        # the morphology operators can only be batched by `_bpgm`
+        self._batch_prox = False
+        self._pending_morph = {}
+
         # update_order for bSDMM is over *all* components
         if self.config.update_order[0] == 0:
             update_order = list(range(2*self.K))
@@ -158,29 +597,277 @@ class Blend(ComponentTree):
 
         # run bSDMM or bPGM on all SEDs and morphologies
         proxs_g = self._proxs_g
+        max_iter = self.it + steps
+        if not getattr(self, "_resume_optimizer", False):
+            # start a new optimization, unless the state was loaded by `load_state`
+            self._X_prev = None
+        self._resume_optimizer = False
+        self._iteration_start = timer()
+        if self.history is not None:
+            self.history.reserve(len(self.history) + steps)
+
+        # use accelerated block-PGM if there's no proxs_g
+        if proxs_g is None or not proxmin.utils.hasNotNone(proxs_g):
+            self._restart_on_resize = False
+            self._bpgm(update_order, max_iter, checkpoint_every=checkpoint_every, checkpoint_path=checkpoint_path)
+            return self
+
+        # proxmin.algorithms.bsdmm has to be restarted when components are resized
+        self._restart_on_resize = True
+        self._resized = {}
         steps_g = None
         steps_g_update = 'steps_f'
         update = 'cascade'
-        max_iter = self.it + steps
+        if checkpoint_every is not None:
+            # stop the optimizer at the next checkpoint
+            steps = min(steps, checkpoint_every - self.it % checkpoint_every)
         try:
-            # use accelerated block-PGM if there's no proxs_g
-            if proxs_g is None or not proxmin.utils.hasNotNone(proxs_g):
-                res = proxmin.algorithms.bpgm(X, self._prox_f, self._steps_f,
-                    accelerated=self.config.accelerated, update=update,
-                    update_order=update_order, max_iter=steps, e_rel=self._e_rel)
-            else:
-                res = proxmin.algorithms.bsdmm(X, self._prox_f, self._steps_f, proxs_g, steps_g=steps_g,
-                    Ls=self._Ls, update=update, update_order=update_order, steps_g_update=steps_g_update, max_iter=steps,
-                    e_rel=self._e_rel, e_abs=self._e_abs)
+            res = proxmin.algorithms.bsdmm(X, self._prox_f, self._steps_f, proxs_g, steps_g=steps_g,
+                Ls=self._Ls, update=update, update_order=update_order, steps_g_update=steps_g_update, max_iter=steps,
+                e_rel=self._e_rel, e_abs=self._e_abs)
 
             X, converged, errors = res
             # reformat as [(A,S) for k in Blend.K]
             self.converged = np.dstack((converged[::2], converged[1::2]))[0]
 
+            if checkpoint_every is not None:
+                if self.it % checkpoint_every == 0:
+                    self.save_state(checkpoint_path)
+                if not np.all(self.converged) and self.it < max_iter:
+                    # restart the optimizer from the checkpoint
+                    self._fit(max_iter - self.it, e_rel, checkpoint_every=checkpoint_every,
+                              checkpoint_path=checkpoint_path)
+
         except ScarletRestartException:
+            if checkpoint_every is not None and self.it % checkpoint_every == 0:
+                self.save_state(checkpoint_path)
             if self.it < max_iter: # don't restart at last iteration
                 steps = max_iter - self.it
-                self.fit(steps=steps)
+                self._fit(steps, e_rel, checkpoint_every=checkpoint_every, checkpoint_path=checkpoint_path)
+        return self
+
+    def _set_store(self):
+        """Move the parameters of the components into a `~scarlet.storage.ParameterStore`
+
+        The store is created if `Config.parameter_store` is `True` and rebuilt
+        when the components changed. Otherwise the components are detached
+        from a previous store.
+        """
+        if self.config.parameter_store:
+            if (self._store is None or self._store.components != self.components or
+                    self._store.dtype != self._img.dtype):
+                if self._store is not None:
+                    self._store.detach()
+                self._store = ParameterStore(self.components, dtype=self._img.dtype)
+        elif self._store is not None:
+            self._store.detach()
+            self._store = None
+
+    def _bpgm(self, update_order, max_iter, checkpoint_every=None, checkpoint_path=None):
+        """Block proximal gradient method for all SEDs and morphologies
+
+        This is `proxmin.algorithms.bpgm` with `update='cascade'`, but the
+        state of the optimizer (the previous iterate used for the Nesterov
+        acceleration) is kept in the blend.
+        When components are resized (see `_resize_components`) their current
+        and previous morphologies are embedded into the new frames and the fit
+        continues in place, instead of restarting the optimizer.
+        Only the Nesterov sequence is reset after a resize.
+
+        Parameters
+        ----------
+        update_order: list
+            Order in which the SEDs and morphologies are updated,
+            see `proxmin.algorithms.bpgm`.
+        max_iter: int
+            Iteration at which the fit is stopped if it did not converge.
+        checkpoint_every: int, default=`None`
+            Number of iterations between checkpoints (see `fit`).
+        checkpoint_path: str, default=`None`
+            File the checkpoints are written to.
+        """
+        X = [c.sed for c in self.components] + [c.morph for c in self.components]
+        if self._X_prev is None:
+            self._X_prev = [None] * len(X)
+            self._nesterov_t = 1.
+        X_ = self._X_prev
+        converged = None
+        self._batch_prox = self.config.batch_prox
+
+        while self.it < max_iter:
+            # Nesterov acceleration, see `proxmin.utils.NesterovStepper`
+            omega = 0
+            if self.config.accelerated:
+                t = 0.5*(1 + np.sqrt(4*self._nesterov_t*self._nesterov_t + 1))
+                # python float to keep the dtype of X
+                omega = float((self._nesterov_t - 1)/t)
+                self._nesterov_t = t
+
+            self._resized = {}
+            for j in update_order:
+                step = self._steps_f(j, X)
+                if omega > 0 and not self.frozen[j % self.K]:
+                    _X = X[j] + omega*(X[j] - X_[j])
+                else:
+                    _X = X[j]
+                # keep copy for convergence test (and acceleration)
+                X_[j] = X[j].copy()
+                X[j] = self._prox_f(_X, step, Xs=X, j=j)
+
+            # embed the current and previous morphologies in the new frames
+            for k, (old_slice, new_slice) in self._resized.items():
+                j = self.K + k
+                X[j] = self.components[k].morph
+                _X = np.zeros(X[j].shape, dtype=X[j].dtype)
+                _X[new_slice] = X_[j][old_slice]
+                X_[j] = _X
+            if self._resized:
+                # restart the acceleration: the momentum before the resize
+                # pushes the flux further out and leads to more resizing
+                self._nesterov_t = 1.
+
+            if checkpoint_every is not None and self.it % checkpoint_every == 0:
+                self.save_state(checkpoint_path)
+
+            # test for fixed point convergence
+            converged = [proxmin.utils.l2sq(X[j] - X_[j]) <= self._e_rel[j]**2*proxmin.utils.l2sq(X[j])
+                         for j in range(len(X))]
+            if all(converged) or self._stopped:
+                break
+
+        if converged is not None:
+            # reformat as [(A,S) for k in Blend.K]
+            self.converged = np.dstack((converged[::2], converged[1::2]))[0]
+        logger.info("Completed {0} iterations".format(self.it))
+        if not np.all(self.converged):
+            logger.warning("Solution did not converge")
+
+    def save_state(self, path):
+        """Save the state of the fit
+
+        The iteration counter, the state of the optimizer, the cached Lipschitz
+        constants (and the eigenvectors they were computed from), the convergence
+        flags, the cached models (see `_compute_model`) and the SED, morphology,
+        center and frame of every component are written to the numpy `.npz` file
+        `path`. The file is replaced atomically, so an interrupted write
+        does not corrupt an existing checkpoint. Saving the state does not
+        change the fit.
+
+        Parameters
+        ----------
+        path: str
+            Name of the file.
+        """
+        state = {
+            "K": self.K,
+            "it": getattr(self, "it", 0),
+            "converged": getattr(self, "converged", False),
+        }
+        try:
+            # it, stride, last and stored value of the 1/Lipschitz caches
+            state["cbAS"] = np.array([[cb.it, cb.stride, cb.last, np.nan if cb.stored is None else cb.stored]
+                                      for cb in self._cbAS])
+        except AttributeError:
+            pass
+        for block, x in enumerate(self._lipschitz_vectors):
+            if x is not None:
+                state["lipschitz_vector_{0}".format(block)] = x
+        if getattr(self, "_X_prev", None) is not None:
+            # state of the accelerated block-PGM
+            state["nesterov_t"] = self._nesterov_t
+            for j, X_ in enumerate(self._X_prev):
+                if X_ is not None:
+                    state["X_prev_{0}".format(j)] = X_
+        for k, c in enumerate(self.components):
+            state["sed_{0}".format(k)] = c.sed
+            state["morph_{0}".format(k)] = c.morph
+            state["center_{0}".format(k)] = c.center
+            state["frame_{0}".format(k)] = np.array([c.bottom, c.top, c.left, c.right])
+        if getattr(self, "_model_it", -1) >= 0:
+            # the model is updated incrementally, so a resumed fit needs
+            # the cached models to update it in the same way
+            state["model_it"] = self._model_it
+            state["model"] = self._model
+            state["model_A"] = self._A
+            state["model_changed"] = [self._morph_changed(k) for k in range(self.K)]
+            state["edge_flux"] = self._edge_flux
+            for k, bb in enumerate(self._bbs):
+                state["model_{0}".format(k)] = self._models[k]
+                state["bb_{0}".format(k)] = np.array([bb[1].start, bb[1].stop, bb[2].start, bb[2].stop])
+
+        tmp_path = "{0}.tmp".format(path)
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **state)
+        os.replace(tmp_path, path)
+
+    def load_state(self, path):
+        """Load the state of a fit saved with `save_state`
+
+        The blend has to be built from the same sources as the blend
+        the state was saved from, and `set_data` has to be called before
+        `load_state`. A subsequent call to `fit` resumes the fit.
+
+        Parameters
+        ----------
+        path: str
+            Name of the file.
+
+        Returns
+        -------
+        self: `~scarlet.blend.Blend`
+        """
+        try:
+            self.config
+        except AttributeError:
+            raise RuntimeError("config not set: call set_data() before load_state()!")
+
+        with np.load(path) as state:
+            if int(state["K"]) != self.K:
+                msg = "State has {0} components, but the blend has {1}"
+                raise ValueError(msg.format(int(state["K"]), self.K))
+            for k, c in enumerate(self.components):
+                c.sed = state["sed_{0}".format(k)].copy()
+                c.morph = state["morph_{0}".format(k)].copy()
+                c.set_center(state["center_{0}".format(k)])
+                c.bottom, c.top, c.left, c.right = [int(x) for x in state["frame_{0}".format(k)]]
+
+            self.it = int(state["it"])
+            self._model_it = -1
+            if "model_it" in state:
+                self._model_it = int(state["model_it"])
+                self._model = state["model"].copy()
+                self._A = state["model_A"].copy()
+                self._edge_flux = state["edge_flux"].copy()
+                self._models, self._bbs, self._model_keys = [], [], []
+                for k, c in enumerate(self.components):
+                    self._models.append(state["model_{0}".format(k)].copy())
+                    bottom, top, left, right = [int(x) for x in state["bb_{0}".format(k)]]
+                    self._bbs.append((slice(None), slice(bottom, top), slice(left, right)))
+                    if state["model_changed"][k]:
+                        # the morphology changed after the model was computed
+                        self._model_keys.append((-1, None, None))
+                    else:
+                        self._model_keys.append((c.morph_version, c.Gamma, (c.bottom, c.left)))
+            self.converged = state["converged"]
+            if self.converged.ndim == 0:
+                self.converged = bool(self.converged)
+            self._cbAS = [proxmin.utils.ApproximateCache(self._one_over_lipschitz, slack=self.config.slack),
+                          proxmin.utils.ApproximateCache(self._one_over_lipschitz, slack=self.config.slack)]
+            if "cbAS" in state:
+                for cb, (it, stride, last, stored) in zip(self._cbAS, state["cbAS"]):
+                    cb.it, cb.stride, cb.last = int(it), int(stride), int(last)
+                    cb.stored = None if np.isnan(stored) else stored
+            self._lipschitz_vectors = [state["lipschitz_vector_{0}".format(block)].copy()
+                                       if "lipschitz_vector_{0}".format(block) in state else None
+                                       for block in range(2)]
+            if "nesterov_t" in state:
+                self._nesterov_t = state["nesterov_t"][()]
+                self._X_prev = [state["X_prev_{0}".format(j)].copy() if "X_prev_{0}".format(j) in state else None
+                                for j in range(2*self.K)]
+                # continue with the same momentum in the next call to `fit`
+                self._resume_optimizer = True
+            else:
+                self._X_prev = None
         return self
 
     def get_model(self, k=None, combine=True, use_sed=True):
@@ -200,23 +887,51 @@ class Blend(ComponentTree):
         `~numpy.array` with shape (B, Ny, Nx)
         """
         if k is not None:
-            c = self.components[k]
-            model = c.get_model(use_sed=use_sed)
-            model_slice = c.get_slice_for(self._img.shape)
-
-            # keep record of flux at edge of the component model
-            self._set_edge_flux(k, model)
-
-            model_img = np.zeros(self._img.shape)
-            model_img[c.bb] = model[model_slice]
+            model, bb = self._get_box_model(k, use_sed=use_sed)
+            model_img = np.zeros(self._img.shape, dtype=self._img.dtype)
+            model_img[bb] = model
             return model_img
 
         # for all components
         if combine:
-            return np.sum([self.get_model(k=k, use_sed=use_sed) for k in range(self.K)], axis=0)
+            model_img = np.zeros(self._img.shape, dtype=self._img.dtype)
+            for k in range(self.K):
+                model, bb = self._get_box_model(k, use_sed=use_sed)
+                model_img[bb] += model
+            return model_img
         else:
             return np.array([self.get_model(k=k, use_sed=use_sed) for k in range(self.K)])
 
+    def _get_box_model(self, k, use_sed=True):
+        """Compute the model of a single component in its bounding box.
+
+        Parameters
+        ----------
+        k: int
+            Index of the component.
+        use_sed: bool
+            Whether the component is "colored" vs monochromatic.
+
+        Returns
+        -------
+        model: `~numpy.array`
+            (Bands, Height, Width) model of component `k`, truncated to the
+            part of its frame that overlaps with the image.
+        bb: tuple of slices
+            Bounding box of `model` in the full image, such that
+            `img[bb]` has the same shape as `model`.
+        """
+        c = self.components[k]
+        model = c.get_model(use_sed=use_sed)
+
+        # keep record of flux at edge of the component model
+        self._set_edge_flux(k, model)
+
+        model = model[c.get_slice_for(self._img.shape)]
+        bottom, left = max(0, c.bottom), max(0, c.left)
+        bb = (slice(None), slice(bottom, bottom + model.shape[1]), slice(left, left + model.shape[2]))
+        return model, bb
+
     def _set_weights(self, weights):
         """Set the weights and pixel covariance matrix `_Sigma_1`.
 
@@ -227,13 +942,17 @@ class Blend(ComponentTree):
 
         Returns
         -------
-        None, but sets `self._Sigma_1` and `self._weights`.
+        None, but sets `self._Sigma_1`, `self._weights` and `self._data_weights`.
         """
         import scipy.sparse
         if weights is None:
             self._weights = [1,1]
+            self._data_weights = 1
         else:
             self._weights = [None] * 2
+            weights = np.asarray(weights, dtype=self.config.dtype)
+            # the weights of the data for the chi^2 (see `_get_chi2`)
+            self._data_weights = weights
 
             # for S update: normalize the per-pixel variation
             # i.e. in every pixel: utilize the bands with large weights
@@ -263,21 +982,109 @@ class Blend(ComponentTree):
 
         Calculate the full model once per iteration.
         This creates `self._models`, the morphological model of each component
-        projected onto the full image, and `self._model`, which weighs
+        in its bounding box `self._bbs`, and `self._model`, which weighs
         those models with the SED for each component and adds them into a
-        single model.
+        single full-frame model.
+
+        The morphological model of a component is only recomputed if its
+        morphology, center (i.e. `Gamma`) or frame changed.
+        If only a few components changed since the last iteration, the model
+        is updated incrementally by subtracting their previous contribution
+        and adding the new one.
+        To avoid an accumulation of rounding errors, the model is rebuilt from
+        scratch every `~scarlet.config.Config.refine_skip` iterations.
+        The model is also rebuilt when `self._model_it` is set to -1, which is
+        necessary after changing a morphology in place.
         """
         # make sure model at current iteration is computed when needed
         # irrespective of function that needs it
         if self._model_it < self.it:
-            # model each each component over image
+            with self._timer("model"):
+                if (getattr(self, "_model", None) is None or self._model.shape != self._img.shape or
+                        self._model_it < 0 or self.it % self.config.refine_skip == 0):
+                    if getattr(self, "_model", None) is None or self._model.shape != self._img.shape:
+                        self._model = np.zeros(self._img.shape, dtype=self._img.dtype)
+                    self._models = [None] * self.K
+                    self._bbs = [None] * self.K
+                    self._A = np.empty((self.B,self.K), dtype=self._img.dtype)
+                    # morphology, Gamma and frame of the cached models
+                    self._model_keys = [None] * self.K
+
+                # find the components that changed since the last iteration
+                if self._store is not None:
+                    # compare all SEDs at once
+                    sed_changed = np.any(self._A != self._store.sed.T, axis=0)
+                else:
+                    sed_changed = [not np.array_equal(self._A[:,k], self.components[k].sed) for k in range(self.K)]
+                changed = []
+                for k in range(self.K):
+                    morph_changed = self._morph_changed(k)
+                    if morph_changed or sed_changed[k]:
+                        changed.append((k, morph_changed))
+
+                if 2*len(changed) > self.K:
+                    # adding all components is faster than
+                    # updating the ones that changed
+                    self._model[:] = 0
+                    for k, morph_changed in changed:
+                        self._update_box_model(k, morph_changed)
+                    for k in range(self.K):
+                        self._model[self._bbs[k]] += self._A[:,k,None,None] * self._models[k]
+                else:
+                    for k, morph_changed in changed:
+                        # remove the previous contribution of the component
+                        if self._model_keys[k] is not None:
+                            self._model[self._bbs[k]] -= self._A[:,k,None,None] * self._models[k]
+                        self._update_box_model(k, morph_changed)
+                        self._model[self._bbs[k]] += self._A[:,k,None,None] * self._models[k]
+                self._model_it = self.it
+
+    def _morph_changed(self, k):
+        """Whether the morphological model of component `k` has to be recomputed
+
+        See `_compute_model`.
+        """
+        c = self.components[k]
+        key = self._model_keys[k]
+        return (key is None or key[0] != c.morph_version or key[1] is not c.Gamma or
+                key[2] != (c.bottom, c.left))
+
+    def _update_box_model(self, k, morph_changed):
+        """Update the cached SED and morphological model of component `k`
+
+        See `_compute_model`.
+        """
+        c = self.components[k]
+        if morph_changed:
+            # model each component only in its bounding box
             # do not use SED, so that it can be reused later
-            self._models = self.get_model(combine=False, use_sed=False)
-            self._A = np.empty((self.B,self.K))
-            for k in range(self.K):
-                self._A[:,k] = self.components[k].sed
-            self._model = np.sum(self._A.T[:,:,None,None] * self._models, axis=0)
-            self._model_it = self.it
+            self._models[k], self._bbs[k] = self._get_box_model(k, use_sed=False)
+            self._model_keys[k] = (c.morph_version, c.Gamma, (c.bottom, c.left))
+        self._A[:,k] = c.sed
+
+    def _get_overlaps(self):
+        """Find all pairs of components with overlapping bounding boxes.
+
+        Returns
+        -------
+        overlaps: list of tuples
+            `(k, l, slice_k, slice_l)` for every pair `k <= l` whose bounding
+            boxes `self._bbs` overlap, where `self._models[k][slice_k]` and
+            `self._models[l][slice_l]` cover the same image pixels.
+        """
+        bbs = np.array([(bb[1].start, bb[1].stop, bb[2].start, bb[2].stop) for bb in self._bbs])
+        bottom = np.maximum(bbs[:,None,0], bbs[None,:,0])
+        top = np.minimum(bbs[:,None,1], bbs[None,:,1])
+        left = np.maximum(bbs[:,None,2], bbs[None,:,2])
+        right = np.minimum(bbs[:,None,3], bbs[None,:,3])
+        overlaps = []
+        for k, l in zip(*np.where(np.triu((top > bottom) & (right > left)))):
+            slice_k = (slice(None), slice(bottom[k,l] - bbs[k,0], top[k,l] - bbs[k,0]),
+                       slice(left[k,l] - bbs[k,2], right[k,l] - bbs[k,2]))
+            slice_l = (slice(None), slice(bottom[k,l] - bbs[l,0], top[k,l] - bbs[l,0]),
+                       slice(left[k,l] - bbs[l,2], right[k,l] - bbs[l,2]))
+            overlaps.append((k, l, slice_k, slice_l))
+        return overlaps
 
     def _prox_f(self, X, step, Xs=None, j=None):
         """Proximal operator for the X update.
@@ -311,6 +1118,10 @@ class Blend(ComponentTree):
         block = j//self.K
         k = j%self.K
 
+        # the acceleration of the optimizer can promote X to double precision
+        if X.dtype != self._img.dtype:
+            X = X.astype(self._img.dtype)
+
         # computing likelihood gradients for S and A:
         # build model only once per iteration
         if k == 0:
@@ -318,18 +1129,37 @@ class Blend(ComponentTree):
                 self._compute_model()
 
             # compute weighted residuals
-            self._diff = self._weights[block]*(self._model-self._img)
+            self._diff = self._get_buffer("diff", self._img.shape)
+            np.subtract(self._model, self._img, out=self._diff)
+            self._diff *= self._weights[block]
+            if block == self.config.update_order[0] and self._unfreeze_thresh:
+                self._check_frozen()
+
+        if self.frozen[k]:
+            # frozen components are not updated (see `freeze`)
+            X = self.components[k].sed if block == 0 else self.components[k].morph
+            if self._track_changes:
+                self._changes[k, block] = 0
 
         # A update
-        if block == 0:
+        elif block == 0:
             if not self.components[k].fix_sed:
                 # gradient of likelihood wrt A: nominally np.dot(diff, S^T)
                 # but with PSF convolution, S_ij -> sum_q Gamma_bqi S_qj
                 # however, that's exactly the operation done for models[k]
-                grad = np.einsum('...ij,...ij', self._diff, self._models[k])
+                with self._timer("grad_sed"):
+                    grad = np.einsum('...ij,...ij', self._diff[self._bbs[k]], self._models[k])
 
                 # apply per component prox projection and save in component
-                X = self.components[k].sed =  self.components[k].constraints.prox_sed(X - step*grad, step)
+                with self._timer("prox_sed"):
+                    X_prev = self.components[k].sed
+                    if self._store is not None and self._track_changes:
+                        # the stored SED is overwritten in place
+                        X_prev = X_prev.copy()
+                    self.components[k].sed = self.components[k].constraints.prox_sed(X - step*grad, step)
+                    X = self.components[k].sed
+                if self._track_changes:
+                    self._record_change(j, X_prev, X)
 
         # S update
         elif block == 1:
@@ -337,35 +1167,185 @@ class Blend(ComponentTree):
                 # gradient of likelihood wrt S: nominally np.dot(A^T,diff)
                 # but again: with convolution, it's more complicated
 
-                # first create diff image in frame of component k
-                slice_k = self.components[k].get_slice_for(self._img.shape)
-                diff_k = np.zeros(self.components[k].shape)
-                diff_k[slice_k] = self._diff[self.components[k].bb]
-
-                # now a gradient vector and a mask of pixel with updates
-                grad = np.zeros(X.shape, dtype=X.dtype)
-                if not self.use_psf:
-                    for b in range(self.B):
-                        grad += self.components[k].sed[b]*self.components[k].Gamma.T.dot(diff_k[b])
-                else:
-                    for b in range(self.B):
-                        grad += self.components[k].sed[b]*self.components[k].Gamma[b].T.dot(diff_k[b])
+                with self._timer("grad_morph"):
+                    # first create diff image in frame of component k
+                    c = self.components[k]
+                    diff_k = self._get_frame_diff(k)
+
+                    # now the gradient: sum_b sed[b] * Gamma[b]^T diff_k[b]
+                    if not self.use_psf:
+                        # Gamma is the same in every band: sum the bands first
+                        grad = c.Gamma.T.dot(np.tensordot(c.sed, diff_k, axes=1))
+                    else:
+                        # apply transposed Gamma to all bands at once
+                        gamma_diff = self._get_buffer("gamma_diff", c.shape)
+                        apply_filters([gamma.T for gamma in c.Gamma], diff_k, result=gamma_diff)
+                        grad = np.tensordot(c.sed, gamma_diff, axes=1)
 
                 # apply per component prox projection and save in component
-                X = self.components[k].morph = self.components[k].constraints.prox_morph(X - step*grad, step)
-
+                if self._batch_prox:
+                    # the projection is applied by `_prox_batch` after the last component
+                    X = X - step*grad
+                    self._pending_morph[k] = (X, step)
+                else:
+                    with self._timer("prox_morph"):
+                        X_prev = self.components[k].morph
+                        if self._store is not None and self._track_changes:
+                            # the stored morphology is overwritten in place
+                            X_prev = X_prev.copy()
+                        self.components[k].morph = self.components[k].constraints.prox_morph(X - step*grad, step)
+                        X = self.components[k].morph
+                    if self._track_changes:
+                        self._record_change(j, X_prev, X)
+
+        if block == 1 and k == self.K - 1 and self._batch_prox:
+            self._prox_batch(Xs)
+            if not self.frozen[k] and not self.components[k].fix_morph:
+                X = self.components[k].morph
 
         # resize & recenter: after all blocks are updated
         if k == self.K - 1 and block == self.config.update_order[1]:
             self.it += 1
             self.update_sed()
             self.update_morph()
-            self.update_center()
+            try:
+                self.update_center()
+            finally:
+                self._end_iteration()
 
         return X
 
+    def _prox_batch(self, Xs):
+        """Apply the morphology operators of all pending components (see `Config.batch_prox`)
+
+        The morphologies of components with the same operator and the same shape
+        (see `~scarlet.constraint.ConstraintAdapter.batch_key`) are stacked
+        and updated with a single call of `~scarlet.operator.prox_batch`.
+        All other morphologies are updated one at a time.
+
+        Parameters
+        ----------
+        Xs: list
+            List of all SEDs and morphologies of the model,
+            the morphologies are replaced by the updated morphologies.
+        """
+        pending = self._pending_morph
+        self._pending_morph = {}
+        with self._timer("prox_morph"):
+            updated = {}
+            groups = {}
+            for k, (X, step) in pending.items():
+                constraints = self.components[k].constraints
+                key = constraints.batch_key
+                if key is None:
+                    updated[k] = constraints.prox_morph(X, step)
+                else:
+                    groups.setdefault(key, []).append(k)
+            for ks in groups.values():
+                X, step = pending[ks[0]]
+                prox = self.components[ks[0]].constraints.prox_morph
+                if len(ks) == 1:
+                    updated[ks[0]] = prox(X, step)
+                    continue
+                # the batched operators are projections, which do not depend on the step size
+                if self._store is not None and self._store.members[X.shape] == ks:
+                    # project the morphologies in the stack of the store
+                    stack = self._store.morphs[X.shape]
+                    if self._track_changes:
+                        X_prev = stack.copy()
+                    for n, k in enumerate(ks):
+                        stack[n] = pending[k][0]
+                    prox_batch(prox, stack, step)
+                    for n, k in enumerate(ks):
+                        # the morphology was updated in place:
+                        # assign it to itself to increment `morph_version`
+                        self.components[k].morph = self.components[k].morph
+                        Xs[self.K + k] = self.components[k].morph
+                        if self._track_changes:
+                            self._record_change(self.K + k, X_prev[n], Xs[self.K + k])
+                    continue
+                stack = np.stack([pending[k][0] for k in ks])
+                prox_batch(prox, stack, step)
+                for n, k in enumerate(ks):
+                    updated[k] = stack[n]
+
+        for k, X in updated.items():
+            X_prev = self.components[k].morph
+            if self._store is not None and self._track_changes:
+                X_prev = X_prev.copy()
+            self.components[k].morph = X
+            Xs[self.K + k] = self.components[k].morph
+            if self._track_changes:
+                self._record_change(self.K + k, X_prev, Xs[self.K + k])
+
+    def _get_buffer(self, name, shape):
+        """Get a preallocated scratch array.
+
+        The arrays are allocated once for each `name` and `shape` and reused
+        in every subsequent call, so their content is only valid until the
+        next call with the same `name` and `shape`.
+
+        Parameters
+        ----------
+        name: str
+            Identifier of the buffer.
+        shape: tuple
+            Shape of the buffer.
+
+        Returns
+        -------
+        buffer: `~numpy.array`
+            Uninitialized array with shape `shape`.
+        """
+        try:
+            self._buffers
+        except AttributeError:
+            self._buffers = {}
+        key = (name, tuple(shape))
+        try:
+            return self._buffers[key]
+        except KeyError:
+            self._buffers[key] = np.empty(shape, dtype=self._img.dtype)
+            return self._buffers[key]
+
+    def _get_frame_diff(self, k):
+        """Get the weighted residuals in the frame of component `k`.
+
+        Pixels of the frame outside of the image are set to zero.
+
+        Parameters
+        ----------
+        k: int
+            Index of the component
+
+        Returns
+        -------
+        diff_k: `~numpy.array`
+            (Bands, Height, Width) residuals `self._diff` in the component frame,
+            stored in a scratch buffer (see `_get_buffer`).
+        """
+        c = self.components[k]
+        diff_k = self._get_buffer("diff_k", c.shape)
+        slice_k = c.get_slice_for(self._img.shape)
+        if diff_k[slice_k].shape != diff_k.shape:
+            diff_k[:] = 0
+        diff_k[slice_k] = self._diff[c.bb]
+        return diff_k
+
     def _one_over_lipschitz(self, block):
         """Calculate 1/Lipschitz constant for A and S
+
+        The Lipschitz constants are the largest eigenvalues of the covariance
+        matrices of S or A. They are estimated with `power_iteration`
+        (or the Lanczos method for `~scarlet.config.Config.exact_lipschitz`)
+        starting from the eigenvector of the previous call, and without
+        building the covariance matrices in the serialized frame.
+        The precision of the estimate is set by `~scarlet.config.Config.slack`,
+        the precision that is used by `proxmin.utils.ApproximateCache` to
+        decide how often the Lipschitz constants are recalculated.
+        Both methods converge to the largest eigenvalue from below, so the
+        estimate is increased by the same relative precision to keep the
+        step size below 1/L.
         """
         import scipy.sparse
         import scipy.sparse.linalg
@@ -379,22 +1359,41 @@ class Blend(ComponentTree):
                 # Sigma_a = ((PS)^T Sigma_pixel^-1 PS)^-1
                 # in the frame where A is a vector of length K*B
                 # NOTE: convolution implicitly treated in the models
-                PS = scipy.sparse.block_diag([self._models[:,b,:,:].reshape((self.K, Ny*Nx)).T
-                                                for b in range(self.B)])
+                rows, cols, data = [], [], []
+                for k in range(self.K):
+                    bb = self._bbs[k]
+                    idx = (np.arange(bb[1].start, bb[1].stop)[:,None] * Nx +
+                           np.arange(bb[2].start, bb[2].stop)[None,:]).flatten()
+                    for b in range(self.B):
+                        rows.append(b*Ny*Nx + idx)
+                        cols.append(np.full(idx.size, b*self.K + k))
+                        data.append(self._models[k][b].flatten())
+                PS = scipy.sparse.coo_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                                             shape=(B*Ny*Nx, B*self.K)).tocsr()
                 # Lipschitz constant for grad_A = || S Sigma_1 S.T||_s
-                SSigma_1S = PS.T.dot(self._Sigma_1[0].dot(PS))
-                LA = np.real(scipy.sparse.linalg.eigs(SSigma_1S, k=1, return_eigenvectors=False)[0])
+                matvec = lambda x: PS.T.dot(self._Sigma_1[0].dot(PS.dot(x)))
+                size = B*self.K
             else:
                 # Lipschitz constant for grad_A = || S S.T||_s
                 # and the PSF is implicit
                 # NOTE: if PSFs are very different between bands, this will fail
                 # because we average over the bands
-                PS = self._models.mean(axis=1).reshape((self.K, Ny*Nx))
-                SSigma_1S = PS.dot(PS.T)
-                LA = np.real(np.linalg.eigvals(SSigma_1S).max())
-            return 1./LA
-
-        if block == 1: # S
+                # only overlapping bounding boxes contribute to S S.T
+                PS = [model.mean(axis=0) for model in self._models]
+                rows, cols, data = [], [], []
+                for k, l, slice_k, slice_l in self._get_overlaps():
+                    value = np.sum(PS[k][slice_k[1:]] * PS[l][slice_l[1:]])
+                    rows.append(k)
+                    cols.append(l)
+                    data.append(value)
+                    if k != l:
+                        rows.append(l)
+                        cols.append(k)
+                        data.append(value)
+                SSigma_1S = scipy.sparse.coo_matrix((data, (rows, cols)), shape=(self.K, self.K)).tocsr()
+                matvec = SSigma_1S.dot
+                size = self.K
+        elif block == 1: # S
             if self.config.exact_lipschitz:
                 if not self.use_psf:
                     # Lipschitz constant for grad_S = || A.T Sigma_1 A||_s
@@ -407,14 +1406,32 @@ class Blend(ComponentTree):
                     # in the frame where S is a vector of length N*K
                     PA = scipy.sparse.bmat([[self._A[b,k] * self._Gamma_full[k][b]
                                             for k in range(self.K)] for b in range(self.B)])
-                ASigma_1A = PA.T.dot(self._Sigma_1[1].dot(PA))
-                LS = np.real(scipy.sparse.linalg.eigs(ASigma_1A, k=1, return_eigenvectors=False)[0])
+                PA = PA.tocsr()
+                matvec = lambda x: PA.T.dot(self._Sigma_1[1].dot(PA.dot(x)))
+                size = self.K*Ny*Nx
             else:
                 # Lipschitz constant for grad_S = || A.T Sigma_1 A||_s
-                ASigma_1A = self._A.T.dot(self._A)
-                LS = np.real(np.linalg.eigvals(ASigma_1A).max())
-            return 1./LS
-        raise NotImplementedError("block {0} not < 2!".format(block))
+                A = self._A.astype(np.float64)
+                matvec = lambda x: A.T.dot(A.dot(x))
+                size = self.K
+        else:
+            raise NotImplementedError("block {0} not < 2!".format(block))
+
+        # warm start from the previous eigenvector
+        x0 = self._lipschitz_vectors[block]
+        if x0 is None or x0.size != size:
+            x0 = np.ones(size)
+        e_rel = self.config.slack / 100 if self.config.slack > 0 else 1e-6
+        if self.config.exact_lipschitz:
+            # power iterations converge slowly for the large covariance
+            # matrices in the serialized frame, so use the Lanczos method
+            # without building the matrix
+            M = scipy.sparse.linalg.LinearOperator((size, size), matvec=matvec, dtype=np.float64)
+            L, x = scipy.sparse.linalg.eigsh(M, k=1, which="LA", tol=e_rel, v0=x0)
+            L, self._lipschitz_vectors[block] = L[0], x[:,0]
+        else:
+            L, self._lipschitz_vectors[block] = power_iteration(matvec, x0, e_rel=e_rel)
+        return 1./(L*(1+e_rel))
 
     def _steps_f(self, j, Xs):
         """Calculate the current step-size for prox f
@@ -446,7 +1463,9 @@ class Blend(ComponentTree):
             self._compute_model()
             # compute step sizes and save to reuse for every component of A or S
             # _cbAS is the cached values 1/Lipschitz for A and S
-            self._stepAS = [self._cbAS[block](block) for block in [0,1]]
+            # use python floats to keep the dtype of the arrays they multiply
+            with self._timer("lipschitz"):
+                self._stepAS = [float(self._cbAS[block](block)) for block in [0,1]]
 
         return self._stepAS[block]
 
@@ -498,32 +1517,41 @@ class Blend(ComponentTree):
         """
         resized = False
         if self.it % self.config.refine_skip == 0:
-            self._recenter_components()
+            with self._timer("recenter"):
+                self._recenter_components()
 
-            # call nodes to update centers
-            for i in range(self.n_nodes):
-                node = self[i]
-                if isinstance(node, ComponentTree):
-                    node.update_center()
+                # call nodes to update centers
+                for i in range(self.n_nodes):
+                    node = self[i]
+                    if isinstance(node, ComponentTree):
+                        node.update_center()
 
-            resized = self._resize_components()
+            with self._timer("resize"):
+                resized = self._resize_components()
             self._adjust_absolute_error()
 
-        if resized:
+        if resized and self._restart_on_resize:
             raise ScarletRestartException()
 
     def _recenter_components(self):
         """Shift center position of components to minimize residuals in all bands
+
+        The shifts of all components are fit simultaneously by linear least squares,
+        using the differential images (see `_get_shift_differential`) as the basis.
+        Each differential image is only computed in the bounding box of its component,
+        so the normal matrix is block-sparse with non-zero blocks only for
+        components with overlapping bounding boxes.
         """
-        # residuals weighted with full/original weight matrix
-        y = self._weights[1]*(self._model-self._img)
+        import scipy.sparse
+        import scipy.sparse.linalg
 
-        # Create the differential images for all components
-        MT = []
+        # Create the differential images for all components in their bounding boxes
+        diffs = {}
+        rhs = []
         updated = []
         for k in range(self.K):
             c = self.components[k]
-            if c.shift_center:
+            if c.shift_center and not self.frozen[k]:
                 diff_x,diff_y = self._get_shift_differential(k)
                 if np.sum(diff_x)==0 or np.sum(diff_y)==0:
                     # The component might not have any flux,
@@ -532,34 +1560,48 @@ class Blend(ComponentTree):
                     continue
                 diff_x[:,:,-1] = 0
                 diff_y[:,-1,:] = 0
+                diffs[k] = np.array([diff_x, diff_y])
 
-                # Project the difference image onto the full difference model
-                # (which contains the difference images for all components)
-                _img_x = np.zeros(y.shape)
-                _img_x[c.bb] = diff_x
-                _img_y = np.zeros(y.shape)
-                _img_y[c.bb] = diff_y
+                # residuals weighted with full/original weight matrix
+                bb = self._bbs[k]
+                weights = self._weights[1] if np.isscalar(self._weights[1]) else self._weights[1][bb]
+                y = weights * (self._model[bb] - self._img[bb])
+                rhs.append(np.einsum('abij,bij->a', diffs[k], y))
                 updated.append(k)
-                MT.append(_img_x.flatten())
-                MT.append(_img_y.flatten())
-        if len(MT)==0:
+        if len(updated)==0:
             # No components needing updates
             logger.debug("No component centers updated")
             return
 
-        MT = np.array(MT)
+        # normal matrix MT.MT^T from the overlapping pairs of differential images
+        index = dict((k, i) for i, k in enumerate(updated))
+        rows, cols, data = [], [], []
+        for k, l, slice_k, slice_l in self._get_overlaps():
+            if k not in diffs or l not in diffs:
+                continue
+            block = np.einsum('abij,cbij->ac', diffs[k][(slice(None),) + slice_k], diffs[l][(slice(None),) + slice_l])
+            i, j = 2*index[k], 2*index[l]
+            for a in range(2):
+                for b in range(2):
+                    rows.append(i+a)
+                    cols.append(j+b)
+                    data.append(block[a,b])
+                    if k != l:
+                        rows.append(j+b)
+                        cols.append(i+a)
+                        data.append(block[a,b])
+        n = 2*len(updated)
+        MMT = scipy.sparse.csc_matrix((data, (rows, cols)), shape=(n, n))
+
         # Simultaneously fit the positions
-        if not hasattr(self._weights,'shape'): # no/flat weights
-            result = np.dot(np.dot(np.linalg.inv(np.dot(MT, MT.T)), MT), y.flatten())
-        else:
-            w = self._weights.flatten()[:,None]
-            result = np.dot(np.dot(np.linalg.inv(np.dot(MT, MT.T*w)), MT), y.flatten())
+        result = scipy.sparse.linalg.spsolve(MMT, np.concatenate(rhs))
+        if not np.all(np.isfinite(result)):
+            logger.debug("singular position fit, skipping recentering in it {0}".format(self.it))
+            return
 
         # Apply the corrections to all of the components
-        for k in range(self.K):
-            if k not in updated:
-                continue
-            _k = updated.index(k)
+        for k in updated:
+            _k = index[k]
             ddx, ddy = result[2*_k:2*_k+2]
             if ddx**2 + ddy**2 > self.config.center_min_dist**2:
                 c = self.components[k]
@@ -567,6 +1609,8 @@ class Blend(ComponentTree):
                 c.set_center(center)
                 msg = "shifting component {0} by ({1:.3f}/{2:.3f}) to ({3:.3f}/{4:.3f}) in it {5}"
                 logger.debug(msg.format(c.coord, ddy, ddx, c.center[0], c.center[1], self.it))
+                if self.history is not None:
+                    self.history.events.append((self.it, k, "recenter", (float(ddy), float(ddx))))
 
     def _get_shift_differential(self, k):
         """Calculate the difference image used ot fit positions
@@ -584,7 +1628,7 @@ class Blend(ComponentTree):
         # compute (model - dxy*shifted_model)/dxy for first-order derivative
         c = self.components[k]
         slice_k = c.get_slice_for(self._img.shape)
-        model_k = self._models[k][c.bb] * c.sed[:,None,None]
+        model_k = self._models[k] * c.sed[:,None,None]
 
         # get Gamma matrices of component k with additional shift
         offset = c.shift_center
@@ -640,7 +1684,7 @@ class Blend(ComponentTree):
         resized = False
         for k in range(self.K):
             c = self.components[k]
-            if not c.fix_frame:
+            if not c.fix_frame and not self.frozen[k]:
                 size = [c.Ny, c.Nx]
                 increase = 1 # minimal increase, new size will be determine by config
                 newsize = [self.config.find_next_source_size(size[i] + increase) for i in range(2)]
@@ -660,7 +1704,11 @@ class Blend(ComponentTree):
                 if resized_component:
                     logger.info("resizing component {0} from ({1},{2}) to ({3},{4}) at it {5}" .format(
                         c.coord, _size[0], _size[1], size[0], size[1], self.it))
-                    c.resize(size)
+                    slices = c.resize(size)
+                    if slices is not None:
+                        self._resized[k] = slices
+                    if self.history is not None:
+                        self.history.events.append((self.it, k, "resize", (c.Ny, c.Nx)))
         return resized
 
     def _absolute_morph_error(self):
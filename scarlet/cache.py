@@ -1,28 +1,352 @@
+from __future__ import print_function, division
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from functools import partial
+
+import numpy as np
+import scipy.sparse
+
+import logging
+logger = logging.getLogger("scarlet.cache")
+
+
+def get_nbytes(content, _seen=None):
+    """Estimate the memory used by `content`
+
+    Counts the bytes of all `numpy` arrays and `scipy.sparse` matrices that
+    are contained in `content`, including the arrays stored in lists, tuples,
+    dicts, `functools.partial` objects and attributes of other objects.
+
+    Parameters
+    ----------
+    content: object
+        The object to measure.
+
+    Returns
+    -------
+    nbytes: int
+        Estimated number of bytes.
+    """
+    if _seen is None:
+        _seen = set()
+    if id(content) in _seen:
+        return 0
+    _seen.add(id(content))
+
+    if isinstance(content, np.ndarray):
+        return content.nbytes
+    if scipy.sparse.issparse(content):
+        return sum([getattr(content, attr).nbytes for attr in ["data", "indices", "indptr", "row", "col", "offsets"]
+                    if isinstance(getattr(content, attr, None), np.ndarray)])
+    if isinstance(content, partial):
+        return get_nbytes(content.args, _seen) + get_nbytes(content.keywords, _seen)
+    if isinstance(content, (list, tuple)):
+        return sum([get_nbytes(c, _seen) for c in content])
+    if isinstance(content, dict):
+        return sum([get_nbytes(c, _seen) for c in content.values()])
+    if hasattr(content, "__dict__"):
+        return get_nbytes(vars(content), _seen)
+    return sys.getsizeof(content)
+
+
+def _encode(content):
+    """Convert `content` into a dictionary of arrays that can be saved with `numpy.savez`
+
+    Returns `None` if the type of `content` is not supported.
+    """
+    import proxmin
+    if isinstance(content, (list, tuple)):
+        if not all([isinstance(c, np.ndarray) and c.dtype != object for c in content]):
+            return None
+        result = dict(("arr_{0}".format(i), c) for i, c in enumerate(content))
+        result["type"] = np.array(type(content).__name__)
+        return result
+    if isinstance(content, proxmin.utils.MatrixAdapter):
+        if not scipy.sparse.issparse(content.L):
+            return None
+        result = _encode(content.L)
+        result["type"] = np.array("MatrixAdapter")
+        result["axis"] = np.array(-1 if content.axis is None else content.axis)
+        result["spec_norm"] = np.array(np.nan if content._spec_norm is None else content._spec_norm)
+        return result
+    if scipy.sparse.issparse(content):
+        coo = content.tocoo()
+        return {"type": np.array("sparse"), "format": np.array(content.format), "shape": np.array(coo.shape),
+                "data": coo.data, "row": coo.row, "col": coo.col}
+    return None
+
+
+def _decode(arrays):
+    """Restore content encoded with `_encode`
+    """
+    import proxmin
+    _type = str(arrays["type"])
+    if _type in ["list", "tuple"]:
+        content = [arrays["arr_{0}".format(i)] for i in range(len(arrays.files) - 1)]
+        return content if _type == "list" else tuple(content)
+    if _type in ["sparse", "MatrixAdapter"]:
+        shape = tuple(arrays["shape"])
+        content = scipy.sparse.coo_matrix((arrays["data"], (arrays["row"], arrays["col"])), shape=shape)
+        content = content.asformat(str(arrays["format"]))
+        if _type == "MatrixAdapter":
+            axis = int(arrays["axis"])
+            content = proxmin.utils.MatrixAdapter(content, axis=None if axis < 0 else axis)
+            spec_norm = float(arrays["spec_norm"])
+            content._spec_norm = None if np.isnan(spec_norm) else spec_norm
+        return content
+    raise ValueError("Unknown cache content type {0}".format(_type))
+
+
 class Cache:
     """Cache to hold all complex proximal operators, transformation etc.
 
     Convention to use is that the lookup `name` refers to the class or method
     that pushes content onto the cache, the `key` can be chosen at will.
 
+    Every `name` is a separate namespace with a least-recently-used eviction
+    policy: when the estimated size of the content of a namespace
+    (see `get_nbytes`) exceeds its limit (`Cache.max_bytes` or the limit set
+    with `set_limit`), the entries that were used least recently are removed.
+    All methods are thread-safe.
+
+    Optionally, content is also stored on disk in `Cache.directory`
+    (set with `set_directory` or the `SCARLET_CACHE_DIR` environment variable).
+    When the content is not in memory, `check` falls through to the disk, so
+    processes that share the directory only compute each operator once.
+    Arrays are stored as `.npy` files that are memory mapped when they are read;
+    lists and tuples of arrays, `scipy.sparse` matrices and
+    `proxmin.utils.MatrixAdapter` objects are stored as `.npz` files.
+    Other content (e.g. functions) is only cached in memory.
+    Files are named by the hash of `name` and `key`, so `key` has to have
+    a deterministic `repr`.
     """
     _cache = {}
+    _nbytes = {}
+    # limits of the namespaces that do not use `max_bytes`, see `set_limit`
+    _limits = {
+        # operators of rectangular frames that are cheap to derive from the square ones
+        "DirectMonotonicityConstraint.prox_morph_crop": 2**25,
+    }
+    _stats = {}
+    _lock = threading.RLock()
+
+    # default limit of each namespace in bytes (`None` for no limit)
+    max_bytes = 2**28
+    # directory of the on-disk cache (`None` to only cache in memory)
+    directory = os.environ.get("SCARLET_CACHE_DIR")
 
     @staticmethod
-    def check(name, key):
+    def _init(name):
+        """Create the namespace `name` if it does not exist
+        """
+        if name not in Cache._cache:
+            Cache._cache[name] = OrderedDict()
+            Cache._nbytes[name] = 0
+            Cache._stats[name] = {"hits": 0, "misses": 0, "evictions": 0, "disk_hits": 0, "disk_writes": 0}
+
+    @staticmethod
+    def _get_path(name, key):
+        """Path of the file for `key` in namespace `name`, without extension
+        """
+        digest = hashlib.sha1(repr((name, key)).encode("utf-8")).hexdigest()
+        return os.path.join(Cache.directory, name, digest)
+
+    @staticmethod
+    def _load(name, key):
+        """Load the content for `key` in namespace `name` from disk
+
+        Raises a `KeyError` if there is no file for `key`.
+        A file that cannot be read (e.g. because it is corrupt or was
+        truncated) is removed, so that it is replaced by the next `set`,
+        and also raises a `KeyError`.
+        """
+        path = Cache._get_path(name, key)
+        for ext in [".npy", ".npz"]:
+            if not os.path.exists(path + ext):
+                continue
+            try:
+                if ext == ".npy":
+                    return np.load(path + ext, mmap_mode="r")
+                with np.load(path + ext) as arrays:
+                    return _decode(arrays)
+            except Exception as error:
+                logger.warning("Removing unreadable file {0} from the disk cache: {1}".format(path + ext, error))
+                try:
+                    os.remove(path + ext)
+                except OSError:
+                    # removed by another process
+                    pass
+        raise KeyError(key)
+
+    @staticmethod
+    def _save(name, key, content):
+        """Save `content` to disk, if it has a supported type
+
+        Returns whether a file was written.
+        """
+        if isinstance(content, np.ndarray) and content.dtype != object:
+            ext = ".npy"
+        else:
+            content = _encode(content)
+            if content is None:
+                return False
+            ext = ".npz"
+        path = Cache._get_path(name, key) + ext
+        if os.path.exists(path):
+            return False
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # created by another process
+                pass
+        # write to a temporary file and rename it so that other processes
+        # never read a partially written file
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix=ext)
         try:
-            Cache._cache[name]
-        except KeyError:
-            Cache._cache[name] = {}
-        return Cache._cache[name][key]
+            with os.fdopen(fd, "wb") as f:
+                if ext == ".npy":
+                    np.save(f, content)
+                else:
+                    np.savez(f, **content)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return True
+
+    @staticmethod
+    def check(name, key):
+        """Get the content stored for `key` in namespace `name`
+
+        Raises a `KeyError` if the content is not cached.
+        """
+        with Cache._lock:
+            Cache._init(name)
+            try:
+                content, nbytes = Cache._cache[name].pop(key)
+            except KeyError:
+                if Cache.directory is None:
+                    Cache._stats[name]["misses"] += 1
+                    raise
+                try:
+                    content = Cache._load(name, key)
+                except KeyError:
+                    Cache._stats[name]["misses"] += 1
+                    raise
+                Cache._stats[name]["disk_hits"] += 1
+                Cache._set(name, key, content, get_nbytes(content))
+                return content
+            # move to the end of the LRU order
+            Cache._cache[name][key] = (content, nbytes)
+            Cache._stats[name]["hits"] += 1
+            return content
 
     @staticmethod
     def set(name, key, content):
-        try:
-            Cache._cache[name]
-        except KeyError:
-            Cache._cache[name] = {}
-        Cache._cache[name][key] = content
+        """Store `content` for `key` in namespace `name`
+        """
+        nbytes = get_nbytes(content)
+        with Cache._lock:
+            Cache._init(name)
+            Cache._set(name, key, content, nbytes)
+            if Cache.directory is not None:
+                try:
+                    if Cache._save(name, key, content):
+                        Cache._stats[name]["disk_writes"] += 1
+                except (IOError, OSError) as error:
+                    logger.warning("Could not write {0} to the disk cache: {1}".format(name, error))
 
     @staticmethod
-    def __repr__(self):
-        repr(Cache._cache)
+    def _set(name, key, content, nbytes):
+        """Store `content` in memory and evict old entries
+        """
+        with Cache._lock:
+            cache = Cache._cache[name]
+            if key in cache:
+                Cache._nbytes[name] -= cache.pop(key)[1]
+            cache[key] = (content, nbytes)
+            Cache._nbytes[name] += nbytes
+
+            # evict the least recently used entries, but keep the new one
+            limit = Cache._limits.get(name, Cache.max_bytes)
+            if limit is not None:
+                while Cache._nbytes[name] > limit and len(cache) > 1:
+                    _key, (_content, _nbytes) = cache.popitem(last=False)
+                    Cache._nbytes[name] -= _nbytes
+                    Cache._stats[name]["evictions"] += 1
+                    logger.debug("evicting {0} from {1} ({2} bytes)".format(_key, name, _nbytes))
+
+    @staticmethod
+    def set_limit(name, max_bytes):
+        """Set the size limit of namespace `name`
+
+        Parameters
+        ----------
+        name: str
+            Namespace of the cache.
+        max_bytes: int
+            Maximum number of bytes, or `None` for no limit.
+        """
+        with Cache._lock:
+            Cache._limits[name] = max_bytes
+
+    @staticmethod
+    def set_directory(directory):
+        """Set the directory of the on-disk cache
+
+        Parameters
+        ----------
+        directory: str
+            Directory to store the cached content in,
+            or `None` to only cache content in memory.
+        """
+        with Cache._lock:
+            if directory is not None and not os.path.isdir(directory):
+                os.makedirs(directory)
+            Cache.directory = directory
+
+    @staticmethod
+    def clear(name=None, disk=False):
+        """Remove all entries of namespace `name`, or of all namespaces if `name` is `None`
+
+        The statistics of the cleared namespaces are reset as well.
+        If `disk` is `True`, the files of the namespaces in the on-disk cache
+        are also removed.
+        """
+        with Cache._lock:
+            names = list(Cache._cache.keys()) if name is None else [name]
+            for _name in names:
+                Cache._cache.pop(_name, None)
+                Cache._nbytes.pop(_name, None)
+                Cache._stats.pop(_name, None)
+            if disk and Cache.directory is not None:
+                if name is None:
+                    names = os.listdir(Cache.directory)
+                for _name in names:
+                    shutil.rmtree(os.path.join(Cache.directory, _name), ignore_errors=True)
+
+    @staticmethod
+    def stats():
+        """Statistics of the cache
+
+        Returns
+        -------
+        stats: dict
+            Dictionary with an entry for each namespace with the number of
+            `entries`, the estimated `bytes` used and the number of `hits`,
+            `misses`, `evictions`, `disk_hits` (entries loaded from disk) and
+            `disk_writes`.
+        """
+        with Cache._lock:
+            result = {}
+            for name in Cache._cache:
+                result[name] = dict(Cache._stats[name], entries=len(Cache._cache[name]), bytes=Cache._nbytes[name])
+            return result
@@ -42,6 +42,8 @@ class Component(object):
             changes in position.
         """
         # set sed and morph
+        self._store = None
+        self._morph_version = 0
         self.B = sed.size
         self.sed = sed.copy()
 
@@ -56,7 +58,7 @@ class Component(object):
                 _Ny += 1
             if _Nx % 2 ==0:
                 _Nx += 1
-            self.morph = np.zeros((_Ny, _Nx))
+            self.morph = np.zeros((_Ny, _Nx), dtype=morph.dtype)
             self.morph[:Ny,:Nx] = morph[:,:]
 
         # set up psf and translations matrices
@@ -87,6 +89,57 @@ class Component(object):
         self._index = None
         self._parent = None
 
+    @property
+    def sed(self):
+        """SED of the component
+
+        When the component is in a `~scarlet.storage.ParameterStore`, this is
+        a view into the SED matrix of the store and a new SED is copied into it.
+        """
+        return self._sed
+
+    @sed.setter
+    def sed(self, sed):
+        if self._store is None:
+            self._sed = sed
+        elif sed is not self._sed:
+            if sed.shape != self._sed.shape:
+                raise ValueError("Cannot change the shape of a stored SED from {0} to {1}".format(
+                    self._sed.shape, sed.shape))
+            self._sed[:] = sed
+
+    @property
+    def morph(self):
+        """Morphology of the component
+
+        When the component is in a `~scarlet.storage.ParameterStore`, this is
+        a view into a morphology stack of the store and a new morphology is
+        copied into it. If the shape changes, the stacks of the store are rebuilt.
+        Every assignment increments `morph_version`.
+        """
+        return self._morph
+
+    @morph.setter
+    def morph(self, morph):
+        self._morph_version += 1
+        if self._store is None:
+            self._morph = morph
+        elif morph.shape == self._morph.shape:
+            if morph is not self._morph:
+                self._morph[:] = morph
+        else:
+            self._morph = morph
+            self._store.pack()
+
+    @property
+    def morph_version(self):
+        """Number of assignments to `morph`
+
+        The morphology of a stored component is always the same array,
+        so changes have to be detected with the version.
+        """
+        return self._morph_version
+
     @property
     def Nx(self):
         """Width of the frame
@@ -198,12 +251,11 @@ class Component(object):
             sed = np.ones_like(self.sed)
 
         if not self.has_psf:
-            model = np.empty((self.B, self.Ny, self.Nx))
             model = np.outer(sed, Gamma.dot(self.morph)).reshape(self.B, self.Ny, self.Nx)
         else:
-            model = np.zeros((self.B, self.Ny, self.Nx))
-            for b in range(self.B):
-                model[b] += sed[b] * Gamma[b].dot(self.morph)
+            from .transformation import apply_filters
+            model = apply_filters(Gamma, self.morph)
+            model *= sed[:,None,None]
 
         return model
 
@@ -290,6 +342,11 @@ class Component(object):
         size: float or array-like
             Either a (height,width) shape or a single size to create a
             square (size,size) frame.
+
+        Returns
+        -------
+        old_slice, new_slice: to map subsections of the old to the new morphology
+        (see `get_frame`), or `None` if the shape did not change.
         """
         if hasattr(size, '__iter__'):
             size = size[:2]
@@ -301,9 +358,11 @@ class Component(object):
         if new_slice != old_slice:
             # change morph
             _morph = self.morph.copy()
-            self.morph = np.zeros(size)
+            self.morph = np.zeros(size, dtype=_morph.dtype)
             self.morph[new_slice] = _morph[old_slice]
             self.set_frame()
+            self.constraints.reset()
+            return old_slice, new_slice
 
     def get_morph_error(self, weights):
         """Get error in the morphology
@@ -29,9 +29,33 @@ class Config(object):
         Calculate exact Lipschitz constant in every step (`exact_lipschitz` is `True`)
         or only calculate the Lipschitz constant with significant changes in A,S
         (`exact_lipschitz` is `False`)
+    dtype: `numpy.dtype`, default=`numpy.float64`
+        Floating point type of the SEDs, morphologies, models, residuals and weights.
+        With `numpy.float32` the fit uses half of the memory (and memory bandwidth)
+        at the cost of a lower numerical precision.
+    crop_operators: bool, default=False
+        Whether the default monotonicity operators of rectangular frames are
+        derived from the operators of the enclosing square frames
+        (see `~scarlet.operator.crop_monotonic_weights`).
+        Components can have rectangular frames after resizing, which would
+        otherwise require an operator for every combination of two `source_sizes`.
+    batch_prox: bool, default=False
+        Whether the morphology operators of components with the same operator and
+        the same frame shape are applied to a stack of their morphologies in a single
+        call (see `~scarlet.operator.prox_batch`), which is parallelized if the
+        C++ extension is built with OpenMP.
+        This is only used by the block-PGM optimizer, because the morphologies of all
+        components are only updated after the gradients of all components are computed.
+    parameter_store: bool, default=False
+        Whether the SEDs and morphologies of all components are stored in contiguous
+        arrays during the fit (see `~scarlet.storage.ParameterStore`).
+        Batched morphology operators (see `batch_prox`) are then applied to the
+        morphology stacks of the store without copying them.
     """
     def __init__(self, accelerated=True, update_order=None, slack=0.2, refine_skip=10, source_sizes=None,
-                 center_min_dist=1e-3, edge_flux_thresh=1., exact_lipschitz=False):
+                 center_min_dist=1e-3, edge_flux_thresh=1., exact_lipschitz=False,
+                 dtype=np.float64, crop_operators=False, batch_prox=False,
+                 parameter_store=False):
         """Initialize the Class
 
         Parameters
@@ -48,6 +72,10 @@ class Config(object):
         self.center_min_dist = center_min_dist
         self.edge_flux_thresh = edge_flux_thresh
         self.exact_lipschitz = False
+        self.dtype = np.dtype(dtype)
+        self.crop_operators = crop_operators
+        self.batch_prox = batch_prox
+        self.parameter_store = parameter_store
         if source_sizes is None:
             source_sizes = np.array([15, 25, 45, 75, 115, 165])
         # Call `self.set_source_sizes` to ensure that all sizes are odd
@@ -74,6 +102,65 @@ class Config(object):
         else:
             raise NotImplementedError("Source sizes must be list of numbers")
 
+    def prepare_operators(self, constraints=None, processes=None):
+        """Build the morphology operators for all `source_sizes`
+
+        The operators of the constraints (e.g. the strict monotonicity
+        operator) depend on the shape of the morphology and are built and
+        cached the first time a source with a given box size is fit,
+        which can happen in the middle of a fit when a source is resized.
+        This method builds them in advance for every frame shape
+        `(Ny, Nx)` with `Ny` and `Nx` in `source_sizes`,
+        so that the time per iteration is more predictable.
+        With `crop_operators` only the square shapes are built, because the
+        operators of rectangular frames are derived from them.
+
+        Parameters
+        ----------
+        constraints: list of `~scarlet.constraint.Constraint`, default=`None`
+            Constraints of the sources that will be fit.
+            If `constraints` is `None`, the default constraints of
+            `~scarlet.source.ExtendedSource` are used.
+        processes: int, default=`None`
+            Number of threads used to build the operators.
+            If `processes` is `None` the operators are built serially.
+        """
+        from . import constraint as sc
+
+        if constraints is None:
+            constraints = (sc.SimpleConstraint(),
+                           sc.DirectMonotonicityConstraint(use_nearest=False, dtype=self.dtype,
+                                                           crop=self.crop_operators),
+                           sc.DirectSymmetryConstraint())
+        if isinstance(constraints, sc.Constraint):
+            constraints = [constraints]
+
+        sizes = [int(size) for size in self.source_sizes]
+        if self.crop_operators:
+            shapes = [(size, size) for size in sizes]
+        else:
+            shapes = [(Ny, Nx) for Ny in sizes for Nx in sizes]
+
+        def _prepare(shape):
+            for c in constraints:
+                c.prox_morph(shape)
+                if c.prox_g_morph(shape) is not None:
+                    c.L_morph(shape)
+
+        if processes is None:
+            for shape in shapes:
+                _prepare(shape)
+        else:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(processes)
+            try:
+                # build the largest (slowest) operators first
+                shapes = sorted(shapes, key=lambda shape: shape[0]*shape[1], reverse=True)
+                pool.map(_prepare, shapes, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+
     def find_next_source_size(self, size):
         """Find the smallest source size larger than `size`
 
@@ -1,3 +1,4 @@
+import numpy as np
 import proxmin
 from . import operator
 from . import transformation
@@ -73,6 +74,25 @@ class Constraint(object):
         """
         return None
 
+    def get_key(self, shape):
+        """Return a hashable key of the operators for a given `shape`.
+
+        Constraints with the same key have the same operators.
+        The default key consists of the type, the `shape` and the attributes
+        of the constraint, or is `None` if an attribute is not hashable.
+
+        Parameters
+        ----------
+        shape: tuple of int
+            The shape of the container.
+        """
+        key = (type(self), shape) + tuple(sorted(vars(self).items()))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
 class MinimalConstraint(Constraint):
     """The minimal constraint for sources.
 
@@ -138,7 +158,7 @@ class DirectMonotonicityConstraint(Constraint):
     This creates a $prox_f$ constraint to the morphology that forces it
     to be montonically decreasing from the center.
     """
-    def __init__(self, use_nearest=False, exact=False, thresh=0):
+    def __init__(self, use_nearest=False, exact=False, thresh=0, dtype=np.float64, crop=False):
         """Initialize the constraint
 
         Parameters
@@ -150,15 +170,26 @@ class DirectMonotonicityConstraint(Constraint):
             closer to the peak is used.
             If `exact` is `True`, this argument is ignored.
         exact: bool
-            If `exact` is `True` then the exact (but *extremely slow*) monotonic operator is used.
-            Otherwise `transformation.getRadialMonotonicOp` is used.
+            If `exact` is `True` then the exact projection onto the monotonic cone
+            of the nearest reference pixels is used (see `~scarlet.operator.prox_exact_monotonic`).
+            Otherwise `~scarlet.operator.prox_strict_monotonic` is used.
         thresh: float
             Minimum ratio between the current pixel and it's reference pixel.
             When `thresh=0` (default) a flat morphology is allowed.
+        dtype: `numpy.dtype`, default=`numpy.float64`
+            Floating point type of the morphology (see `~scarlet.config.Config.dtype`).
+        crop: bool
+            If `crop` is `True`, the operators of rectangular frames are derived
+            from the operators of the enclosing square frames
+            (see `~scarlet.operator.crop_monotonic_weights`),
+            so that only the operators of square frames are cached permanently.
+            This is ignored if `use_nearest` or `exact` is `True`.
         """
         self.use_nearest = use_nearest
         self.exact = exact
         self.thresh = thresh
+        self.dtype = np.dtype(dtype)
+        self.crop = crop
 
     def prox_morph(self, shape):
         """Build the proximal operator
@@ -167,16 +198,20 @@ class DirectMonotonicityConstraint(Constraint):
         so this function selects the proper one from a cache.
         """
         prox_name = "DirectMonotonicityConstraint.prox_morph"
-        key = shape
+        crop = self.crop and not self.use_nearest and not self.exact and shape[0] != shape[1]
+        if crop:
+            # operators of rectangular frames are cheap to derive,
+            # so they are kept in a separate namespace with a small limit
+            prox_name = "DirectMonotonicityConstraint.prox_morph_crop"
+        key = (shape, self.use_nearest, self.exact, self.thresh, self.dtype)
         try:
             prox = Cache.check(prox_name, key)
         except KeyError:
             if not self.exact:
-                prox = operator.prox_strict_monotonic(shape, use_nearest=self.use_nearest, thresh=self.thresh)
+                prox = operator.prox_strict_monotonic(shape, use_nearest=self.use_nearest, thresh=self.thresh,
+                                                      dtype=self.dtype, crop=crop)
             else:
-                # cone method for monotonicity: exact but VERY slow
-                G = transformation.getRadialMonotonicOp(shape, useNearest=self.useNearest).toarray()
-                prox = partial(operator.prox_cone, G=G)
+                prox = operator.prox_exact_monotonic(shape, thresh=self.thresh)
             Cache.set(prox_name, key, prox)
         return prox
 
@@ -299,6 +334,14 @@ class ConstraintAdapter(object):
     Using the adapter, the constraints are always evaluated with the current size
     of the component SED and morphology. It implements the same methods as
     `~scarlet.constraints.Constraint`, but without the `shape` argument.
+
+    The proximal operators `prox_sed` and `prox_morph` are combined into a
+    single chain once for every shape and cached, because they are requested
+    for every component in every iteration. The chain of the default
+    morphology constraints is replaced by a single native operator
+    (see `~scarlet.operator.fuse_morph_operators`). The cache assumes that the
+    constraints do not change; it is cleared with `reset`, which
+    `~scarlet.component.Component.resize` calls.
     """
     def __init__(self, constraint, component):
         """Initialize the constraint adapter.
@@ -317,26 +360,78 @@ class ConstraintAdapter(object):
         else:
             raise NotImplementedError("argument `constraint` must be constraint or list of constraints")
         self.component = component
+        self._proxs = {}
+        self._batch_keys = {}
+
+    def reset(self):
+        """Clear the cached proximal operators
+
+        Needs to be called when the constraints are modified.
+        """
+        self._proxs = {}
+        self._batch_keys = {}
+
+    def _get_prox(self, name, shape):
+        """Get the combined proximal operator `name` of all constraints for `shape`
+        """
+        key = (name, shape)
+        try:
+            return self._proxs[key]
+        except KeyError:
+            ops = []
+            for c in self.C:
+                prox = getattr(c, name)(shape)
+                if prox is proxmin.operators.prox_id:
+                    continue
+                # flatten nested chains: the operators are applied in reverse order,
+                # so the order of the flat list is the same as the nested one
+                if type(prox) is proxmin.operators.AlternatingProjections and prox.repeat == 1:
+                    ops += prox.operators
+                else:
+                    ops.append(prox)
+            if len(ops) == 0:
+                prox = proxmin.operators.prox_id
+            elif len(ops) == 1:
+                prox = ops[0]
+            else:
+                prox = None
+                if name == "prox_morph":
+                    # use a single native operator for the default constraints
+                    prox = operator.fuse_morph_operators(ops)
+                if prox is None:
+                    prox = proxmin.operators.AlternatingProjections(ops)
+            self._proxs[key] = prox
+            return prox
 
     @property
     def prox_sed(self):
-        ops = [c.prox_sed(self.component.sed.shape) for c in self.C if c.prox_sed(self.component.sed.shape) is not proxmin.operators.prox_id]
-        if len(ops) == 0:
-            return proxmin.operators.prox_id
-        if len(ops) == 1:
-            return ops[0]
-        else:
-            return proxmin.operators.AlternatingProjections(ops)
+        return self._get_prox("prox_sed", self.component.sed.shape)
 
     @property
     def prox_morph(self):
-        ops = [c.prox_morph(self.component.morph.shape) for c in self.C if c.prox_morph(self.component.morph.shape) is not proxmin.operators.prox_id]
-        if len(ops) == 0:
-            return proxmin.operators.prox_id
-        if len(ops) == 1:
-            return ops[0]
-        else:
-            return proxmin.operators.AlternatingProjections(ops)
+        return self._get_prox("prox_morph", self.component.morph.shape)
+
+    @property
+    def batch_key(self):
+        """Key of the morphology operator for `~scarlet.operator.prox_batch`
+
+        Components with the same key have the same morphology operator,
+        so their morphologies can be projected together. The key consists of
+        the shape and the keys of all constraints (see `Constraint.get_key`),
+        or is `None` if the operator cannot be applied to a stack of morphologies
+        (see `~scarlet.operator.can_batch`).
+        """
+        shape = self.component.morph.shape
+        try:
+            return self._batch_keys[shape]
+        except KeyError:
+            key = None
+            if operator.can_batch(self.prox_morph):
+                keys = tuple(c.get_key(shape) for c in self.C)
+                if all(k is not None for k in keys):
+                    key = (shape,) + keys
+            self._batch_keys[shape] = key
+            return key
 
     @property
     def prox_g_sed(self):
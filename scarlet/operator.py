@@ -4,6 +4,8 @@ from functools import partial
 import numpy as np
 import proxmin
 
+from .cache import Cache
+
 import logging
 logger = logging.getLogger("scarlet.operator")
 
@@ -11,6 +13,12 @@ def _prox_strict_monotonic(X, step, ref_idx, dist_idx, thresh=0):
     """Force an intensity profile to be monotonic
     """
     from . import operators_pybind11
+    if X.dtype != np.float64:
+        # the operator is only implemented in double precision and works in place
+        _X = X.astype(np.float64)
+        operators_pybind11.prox_monotonic(_X.reshape(-1), step, ref_idx, dist_idx, thresh)
+        X[:] = _X
+        return X
     operators_pybind11.prox_monotonic(X.reshape(-1), step, ref_idx, dist_idx, thresh)
     return X
 
@@ -19,6 +27,24 @@ def _prox_weighted_monotonic(X, step, weights, didx, offsets, thresh=0):
     operators_pybind11.prox_weighted_monotonic(X.reshape(-1), step, weights, offsets, didx, thresh)
     return X
 
+def _prox_exact_monotonic(X, step, ref_idx, dist_idx, thresh=0):
+    from . import operators_pybind11
+    operators_pybind11.prox_exact_monotonic(X.reshape(-1), step, ref_idx, dist_idx, thresh)
+    return X
+
+def _prox_default_morph(X, step, weights, didx, offsets, thresh=0, sigma=1, tiny=1e-10):
+    from . import operators_pybind11
+    center = (X.shape[0] // 2) * X.shape[1] + X.shape[1] // 2
+    operators_pybind11.prox_default_morph(X.reshape(-1), step, weights, offsets, didx, thresh, sigma, center, tiny)
+    return X
+
+def _prox_default_morph_stack(X, step, weights, didx, offsets, thresh=0, sigma=1, tiny=1e-10):
+    from . import operators_pybind11
+    center = (X.shape[1] // 2) * X.shape[2] + X.shape[2] // 2
+    operators_pybind11.prox_default_morph_stack(X.reshape(X.shape[0], -1), step, weights, offsets, didx, thresh,
+                                                sigma, center, tiny)
+    return X
+
 def sort_by_radius(shape):
     """Sort indices distance from the center
 
@@ -41,22 +67,89 @@ def sort_by_radius(shape):
         Indices of the element in the image closest to the
         center for each pixel in didx.
     """
-    # Get the center pixels
-    cx = (shape[1]-1) >> 1
-    cy = (shape[0]-1) >> 1
-    # Calculate the distance between each pixel and the peak
-    x = np.arange(shape[1])
-    y = np.arange(shape[0])
-    X,Y = np.meshgrid(x,y)
-    X = X - cx
-    Y = Y - cy
-    distance = np.sqrt(X**2+Y**2)
-    # Get the indices of the pixels sorted by distance from the peak
-    didx = np.argsort(distance.flatten())
+    name = "sort_by_radius"
+    key = tuple(shape)
+    try:
+        didx = Cache.check(name, key)
+    except KeyError:
+        # Get the center pixels
+        cx = (shape[1]-1) >> 1
+        cy = (shape[0]-1) >> 1
+        # Calculate the distance between each pixel and the peak
+        x = np.arange(shape[1])
+        y = np.arange(shape[0])
+        X,Y = np.meshgrid(x,y)
+        X = X - cx
+        Y = Y - cy
+        distance = np.sqrt(X**2+Y**2)
+        # Get the indices of the pixels sorted by distance from the peak
+        didx = np.argsort(distance.flatten())
+        Cache.set(name, key, didx)
     return didx
 
-def prox_strict_monotonic(shape, use_nearest=False, thresh=0):
+def crop_monotonic_weights(shape):
+    """Derive the monotonicity weights of a rectangular frame from a square frame
+
+    The weights and the pixel order of `getRadialMonotonicWeights` and
+    `sort_by_radius` only depend on the position of a pixel relative to the
+    center, so the operator of a rectangular frame is the operator of the
+    enclosing square frame, cropped to the rectangle, with the weights of the
+    neighbors outside of the rectangle removed and the remaining weights
+    renormalized. This only requires the cached operators of square frames.
+
+    Parameters
+    ----------
+    shape: tuple
+        Shape (y,x) of the source frame.
+
+    Returns
+    -------
+    didx: `~numpy.array`
+        Indices of the pixels sorted by distance from the center
+        (see `sort_by_radius`).
+    weights: `~numpy.array`
+        8xN array of the weights of the neighbors of each pixel
+        (see `~scarlet.transformation.getRadialMonotonicWeights`).
+    """
+    from . import transformation
+
+    height, width = shape
+    size = max(height, width)
+    y0 = (size - height) // 2
+    x0 = (size - width) // 2
+
+    # select the pixels of the rectangle, in the order of the square frame
+    sq_didx = sort_by_radius((size, size))
+    y, x = np.divmod(sq_didx, size)
+    inside = (y >= y0) & (y < y0 + height) & (x >= x0) & (x < x0 + width)
+    didx = (y[inside] - y0) * width + x[inside] - x0
+
+    # crop the weights and remove the neighbors outside of the rectangle
+    sq_weights = transformation.getRadialMonotonicWeights((size, size), useNearest=False)
+    weights = sq_weights.reshape(8, size, size)[:, y0:y0+height, x0:x0+width].copy()
+    coords = [(-1,-1), (-1,0), (-1, 1), (0,-1), (0,1), (1, -1), (1,0), (1,1)]
+    for n, (dy, dx) in enumerate(coords):
+        if dy < 0:
+            weights[n, 0] = 0
+        elif dy > 0:
+            weights[n, -1] = 0
+        if dx < 0:
+            weights[n, :, 0] = 0
+        elif dx > 0:
+            weights[n, :, -1] = 0
+    normalize = weights.sum(axis=0)
+    normalize[normalize == 0] = 1
+    weights = (weights / normalize).reshape(8, -1)
+    return didx, weights
+
+def prox_strict_monotonic(shape, use_nearest=False, thresh=0, dtype=np.float64, crop=False):
     """Build the prox_monotonic operator
+
+    `dtype` is the floating point type of the morphologies the operator is
+    applied to, the weights of the operator are stored with the same type.
+    If `crop` is `True` and `use_nearest` is `False`, the operator of a
+    rectangular frame is derived from the operator of the enclosing square
+    frame (see `crop_monotonic_weights`).
     """
     from . import transformation
 
@@ -64,22 +157,138 @@ def prox_strict_monotonic(shape, use_nearest=False, thresh=0):
     if not height % 2 or not width % 2:
         err = "Shape must have an odd width and height, received shape {0}".format(shape)
         raise ValueError(err)
-    didx = sort_by_radius(shape)
 
+    if crop and not use_nearest and height != width:
+        didx, weights = crop_monotonic_weights(shape)
+        offsets = np.array([width*y+x for y,x in [(-1,-1), (-1,0), (-1, 1), (0,-1), (0,1), (1, -1), (1,0), (1,1)]])
+        return partial(_prox_weighted_monotonic, weights=weights.astype(dtype), didx=didx[1:], offsets=offsets,
+                       thresh=thresh)
+
+    didx = sort_by_radius(shape)
     if use_nearest:
         from scipy import sparse
         monotonicOp = transformation.getRadialMonotonicOp(shape, useNearest=True)
-        x_idx, ref_idx = sparse.find(monotonicOp==1)[:2]
+        x_idx, ref_idx = sparse.find(monotonicOp.L == 1)[:2]
         ref_idx = ref_idx[np.argsort(x_idx)]
         result = partial(_prox_strict_monotonic, ref_idx=ref_idx.tolist(),
                          dist_idx=didx.tolist(), thresh=thresh)
     else:
         coords = [(-1,-1), (-1,0), (-1, 1), (0,-1), (0,1), (1, -1), (1,0), (1,1)]
         offsets = np.array([width*y+x for y,x in coords])
-        weights = transformation.getRadialMonotonicWeights(shape, useNearest=False)
+        weights = transformation.getRadialMonotonicWeights(shape, useNearest=False).astype(dtype)
         result = partial(_prox_weighted_monotonic, weights=weights, didx=didx[1:], offsets=offsets, thresh=thresh)
     return result
 
+def prox_exact_monotonic(shape, thresh=0):
+    """Build the exact prox_monotonic operator
+
+    Every pixel is required to be at most `1-thresh` times its reference pixel,
+    the nearest pixel in a line between the pixel and the peak
+    (see `~scarlet.transformation.getRadialMonotonicOp` with `useNearest=True`).
+    The references form a tree with the peak at its root, so the projection onto
+    this cone is an isotonic regression on the tree, which the C++ extension
+    solves exactly by pooling adjacent violators in O(N log N) for N pixels.
+    In contrast to `prox_strict_monotonic`, pixels that are brighter than their
+    reference pixels also raise the reference pixels instead of being clipped.
+    """
+    from . import transformation
+    from scipy import sparse
+
+    height, width = shape
+    if not height % 2 or not width % 2:
+        err = "Shape must have an odd width and height, received shape {0}".format(shape)
+        raise ValueError(err)
+
+    didx = sort_by_radius(shape)
+    # the reference pixel of the peak is the peak itself
+    monotonicOp = transformation.getRadialMonotonicOp(shape, useNearest=True)
+    x_idx, ref_idx = sparse.find(monotonicOp.L == 1)[:2]
+    ref_idx = ref_idx[np.argsort(x_idx)]
+    return partial(_prox_exact_monotonic, ref_idx=ref_idx.astype(np.int32), dist_idx=didx.astype(np.int32),
+                   thresh=thresh)
+
+def fuse_morph_operators(ops):
+    """Replace the default chain of morphology operators with a single operator
+
+    The default constraints of `~scarlet.source.ExtendedSource`
+    (`~scarlet.constraint.SimpleConstraint`,
+    `~scarlet.constraint.DirectMonotonicityConstraint` and
+    `~scarlet.constraint.DirectSymmetryConstraint`) result in the chain
+    `[prox_center_on, prox_plus, prox_monotonic, prox_soft_symmetry]`, which
+    `proxmin.operators.AlternatingProjections` applies in reverse order.
+    The fused operator applies the same chain in place with a single call to
+    the C++ extension, without the temporary arrays of the separate operators.
+
+    Parameters
+    ----------
+    ops: list of functions
+        Proximal operators in the order of `proxmin.operators.AlternatingProjections`.
+
+    Returns
+    -------
+    prox: function
+        The fused operator, or `None` if `ops` is not the default chain
+        (e.g. if the monotonicity operator uses `use_nearest`).
+    """
+    if len(ops) != 4:
+        return None
+    center, plus, monotonic, symmetry = ops
+    if isinstance(center, partial):
+        if center.func is not prox_center_on or center.args or set(center.keywords) - set(["tiny"]):
+            return None
+        tiny = center.keywords.get("tiny", 1e-10)
+    elif center is prox_center_on:
+        tiny = 1e-10
+    else:
+        return None
+    if plus is not proxmin.operators.prox_plus:
+        return None
+    if not isinstance(monotonic, partial) or monotonic.func is not _prox_weighted_monotonic or monotonic.args:
+        return None
+    if not isinstance(symmetry, partial) or symmetry.func is not prox_soft_symmetry or symmetry.args:
+        return None
+    return partial(_prox_default_morph, sigma=symmetry.keywords.get("sigma", 1), tiny=tiny, **monotonic.keywords)
+
+def can_batch(prox):
+    """Whether an operator can be applied to a stack of morphologies
+
+    Operators of the same constraints (see
+    `~scarlet.constraint.ConstraintAdapter.batch_key`) can be applied to a
+    stack of morphologies with the same shape in a single call with `prox_batch`.
+    Currently this is only possible for the fused default operator
+    (see `fuse_morph_operators`).
+
+    Parameters
+    ----------
+    prox: function
+        Proximal operator of a single morphology.
+
+    Returns
+    -------
+    result: bool
+        Whether `prox` can be used with `prox_batch`.
+    """
+    return isinstance(prox, partial) and prox.func is _prox_default_morph and not prox.args
+
+def prox_batch(prox, X, step):
+    """Apply the operator of a single morphology to a stack of morphologies
+
+    Parameters
+    ----------
+    prox: function
+        Proximal operator for which `can_batch` is `True`.
+    X: `~numpy.array`
+        C-contiguous (N, Ny, Nx) stack of morphologies, which is updated in place.
+    step: float
+        Step size of the operator.
+
+    Returns
+    -------
+    X: `~numpy.array`
+        The updated stack of morphologies.
+    """
+    return _prox_default_morph_stack(X, step, **prox.keywords)
+
 def prox_cone(X, step, G=None):
     """Exact projection of components of X onto cone defined by Gx >= 0"""
     k, n = X.shape
@@ -3,6 +3,10 @@
 #include <pybind11/stl.h>
 #include <pybind11/eigen.h>
 #include <algorithm>
+#include <queue>
+#include <stdexcept>
+#include <tuple>
+#include <vector>
 
 namespace py = pybind11;
 
@@ -49,6 +53,167 @@ void prox_weighted_monotonic(
     }
 }
 
+// Fused implementation of the default morphology constraints, applied in place:
+// soft symmetry, weighted monotonicity, positivity and positive center
+// (in the order in which the chain of the separate operators applies them)
+template <typename T, typename M, typename V>
+void prox_default_morph(
+    Eigen::Ref<V> flat_img,
+    double const &step,
+    Eigen::Ref<const M> weights,
+    Eigen::Ref<const IndexVector> offsets,
+    Eigen::Ref<const IndexVector> dist_idx,
+    T const &thresh,
+    double const &sigma,
+    int const &center,
+    double const &tiny
+){
+    const int size = flat_img.size();
+    // Symmetry: average each pixel with the pixel that is reflected
+    // at the center of the frame, which is the pixel with the reversed index
+    if(sigma != 0){
+        const T half_sigma = 0.5*sigma;
+        const T one_minus_sigma = 1-sigma;
+        for(int i=0; i<size/2; i++){
+            const int j = size-1-i;
+            const T sum = flat_img(i) + flat_img(j);
+            const T xi = half_sigma*sum + one_minus_sigma*flat_img(i);
+            const T xj = half_sigma*sum + one_minus_sigma*flat_img(j);
+            flat_img(i) = xi;
+            flat_img(j) = xj;
+        }
+    }
+    // Monotonicity: same as prox_weighted_monotonic
+    for(int d=0; d<dist_idx.size(); d++){
+        int didx = dist_idx(d);
+        T ref_flux = 0;
+        for(int i=0; i<offsets.size(); i++){
+            if(weights(i,didx)>0){
+                int nidx = offsets[i] + didx;
+                ref_flux += flat_img(nidx) * weights(i, didx);
+            }
+        }
+        flat_img(didx) = std::min(flat_img(didx), ref_flux*(1-thresh));
+    }
+    // Positivity and minimal flux in the center
+    for(int i=0; i<size; i++){
+        if(flat_img(i) < 0){
+            flat_img(i) = 0;
+        }
+    }
+    if(T(tiny) > flat_img(center)){
+        flat_img(center) = tiny;
+    }
+}
+
+// Apply prox_default_morph to each morphology in a (n, size) stack of
+// morphologies with the same shape, in parallel when built with OpenMP
+template <typename T, typename M, typename V>
+void prox_default_morph_stack(
+    py::array_t<T, py::array::c_style> stack,
+    double const &step,
+    Eigen::Ref<const M> weights,
+    Eigen::Ref<const IndexVector> offsets,
+    Eigen::Ref<const IndexVector> dist_idx,
+    T const &thresh,
+    double const &sigma,
+    int const &center,
+    double const &tiny
+){
+    if(stack.ndim() != 2){
+        throw std::invalid_argument("stack must be a 2D array");
+    }
+    const ssize_t n = stack.shape(0);
+    const ssize_t size = stack.shape(1);
+    if(size != weights.cols()){
+        throw std::invalid_argument("stack and weights must have the same number of pixels");
+    }
+    T *data = stack.mutable_data();
+
+    py::gil_scoped_release release;
+    #pragma omp parallel for schedule(static)
+    for(ssize_t i=0; i<n; i++){
+        Eigen::Map<V> img(data + i*size, size);
+        prox_default_morph<T, M, V>(img, step, weights, offsets, dist_idx, thresh, sigma, center, tiny);
+    }
+}
+
+// Exact projection onto the monotonic cone defined by a tree of reference pixels:
+// every pixel is at most (1-thresh) times its reference pixel, which is closer
+// to the peak, and the peak is its own reference.
+// This is an isotonic regression on a tree, solved by pooling adjacent violators:
+// the block with the largest value is either merged into the block of its
+// reference pixel (if it violates the constraint) or it is final.
+template <typename T, typename V>
+void prox_exact_monotonic(
+    Eigen::Ref<V> flat_img,
+    double const &step,
+    Eigen::Ref<const IndexVector> ref_idx,
+    Eigen::Ref<const IndexVector> dist_idx,
+    double const &thresh
+){
+    const int size = flat_img.size();
+    // With a threshold, x_i = scale_i * y_i with y_i <= y_ref,
+    // so the regression of y is weighted with scale_i^2
+    std::vector<double> scale(size, 1);
+    for(int d=0; d<dist_idx.size(); d++){
+        int i = dist_idx(d);
+        if(ref_idx(i) != i){
+            scale[i] = scale[ref_idx(i)]*(1-thresh);
+        }
+    }
+    // Each block is identified by its pixel closest to the peak
+    std::vector<int> block(size);
+    std::vector<int> version(size, 0);
+    std::vector<double> sum(size);
+    std::vector<double> norm(size);
+    std::vector<char> closed(size);
+    typedef std::tuple<double, int, int> Entry;
+    std::priority_queue<Entry> queue;
+    for(int i=0; i<size; i++){
+        block[i] = i;
+        sum[i] = scale[i]*flat_img(i);
+        norm[i] = scale[i]*scale[i];
+        closed[i] = ref_idx(i) == i;
+        if(!closed[i]){
+            queue.emplace(sum[i]/norm[i], i, 0);
+        }
+    }
+    auto find = [&block](int i){
+        while(block[i] != i){
+            block[i] = block[block[i]];
+            i = block[i];
+        }
+        return i;
+    };
+    while(!queue.empty()){
+        const Entry entry = queue.top();
+        queue.pop();
+        const int b = std::get<1>(entry);
+        if(closed[b] || version[b] != std::get<2>(entry)){
+            continue;
+        }
+        const int p = find(ref_idx(b));
+        if(std::get<0>(entry) >= sum[p]/norm[p]){
+            // pool the block with the block of its reference pixel
+            block[b] = p;
+            closed[b] = true;
+            sum[p] += sum[b];
+            norm[p] += norm[b];
+            version[p]++;
+            if(!closed[p]){
+                queue.emplace(sum[p]/norm[p], p, version[p]);
+            }
+        } else {
+            closed[b] = true;
+        }
+    }
+    for(int i=0; i<size; i++){
+        const int b = find(i);
+        flat_img(i) = scale[i]*sum[b]/norm[b];
+    }
+}
+
 // Apply a filter to an image
 template <typename M, typename V>
 void apply_filter(
@@ -69,6 +234,66 @@ void apply_filter(
     }
 }
 
+// Apply a filter to each image in a data cube
+// The values and slices of all filters are concatenated, the filter for
+// band b is given by the elements from filter_start(b) to filter_stop(b).
+// If `images` only contains a single image, it is used for every band.
+template <typename T>
+void apply_filters(
+    py::array_t<T, py::array::c_style | py::array::forcecast> images,
+    py::array_t<T, py::array::c_style | py::array::forcecast> values,
+    py::array_t<int, py::array::c_style | py::array::forcecast> y_start,
+    py::array_t<int, py::array::c_style | py::array::forcecast> y_end,
+    py::array_t<int, py::array::c_style | py::array::forcecast> x_start,
+    py::array_t<int, py::array::c_style | py::array::forcecast> x_end,
+    py::array_t<int, py::array::c_style | py::array::forcecast> filter_start,
+    py::array_t<int, py::array::c_style | py::array::forcecast> filter_stop,
+    py::array_t<T, py::array::c_style> result
+){
+    if(images.ndim() != 3 || result.ndim() != 3){
+        throw std::invalid_argument("images and result must be 3D arrays");
+    }
+    const ssize_t bands = result.shape(0);
+    const ssize_t rows = result.shape(1);
+    const ssize_t cols = result.shape(2);
+    if(images.shape(1) != rows || images.shape(2) != cols || (images.shape(0) != 1 && images.shape(0) != bands)){
+        throw std::invalid_argument("images and result must have the same shape");
+    }
+    if(filter_start.size() != bands || filter_stop.size() != bands){
+        throw std::invalid_argument("filter_start and filter_stop need one entry per band");
+    }
+    const ssize_t size = rows*cols;
+    const ssize_t image_stride = images.shape(0) == 1 ? 0 : size;
+    const T *img = images.data();
+    const T *val = values.data();
+    const int *ys = y_start.data();
+    const int *ye = y_end.data();
+    const int *xs = x_start.data();
+    const int *xe = x_end.data();
+    const int *start = filter_start.data();
+    const int *stop = filter_stop.data();
+    T *res = result.mutable_data();
+
+    py::gil_scoped_release release;
+    for(ssize_t b=0; b<bands; b++){
+        const T *image = img + b*image_stride;
+        T *out = res + b*size;
+        std::fill(out, out+size, T(0));
+        for(int n=start[b]; n<stop[b]; n++){
+            const ssize_t height = rows-ys[n]-ye[n];
+            const ssize_t width = cols-xs[n]-xe[n];
+            const T v = val[n];
+            for(ssize_t y=0; y<height; y++){
+                T *out_row = out + (ys[n]+y)*cols + xs[n];
+                const T *image_row = image + (ye[n]+y)*cols + xe[n];
+                for(ssize_t x=0; x<width; x++){
+                    out_row[x] += v * image_row[x];
+                }
+            }
+        }
+    }
+}
+
 PYBIND11_PLUGIN(operators_pybind11)
 {
   py::module mod("operators_pybind11", "Fast proximal operators");
@@ -84,8 +309,38 @@ PYBIND11_PLUGIN(operators_pybind11)
   mod.def("prox_weighted_monotonic", &prox_weighted_monotonic<double, MatrixD, VectorD>,
           "Weighted Monotonic Proximal Operator");
 
-  mod.def("apply_filter", &apply_filter<MatrixF, VectorF>, "Apply a filter to a 2D image");
-  mod.def("apply_filter", &apply_filter<MatrixD, VectorD>, "Apply a filter to a 2D image");
+  mod.def("prox_default_morph", &prox_default_morph<float, MatrixF, VectorF>,
+          "Fused default morphology proximal operator", py::call_guard<py::gil_scoped_release>());
+  mod.def("prox_default_morph", &prox_default_morph<double, MatrixD, VectorD>,
+          "Fused default morphology proximal operator", py::call_guard<py::gil_scoped_release>());
+
+  mod.def("prox_default_morph_stack", &prox_default_morph_stack<float, MatrixF, VectorF>,
+          "Fused default morphology proximal operator for a stack of morphologies",
+          py::arg("stack").noconvert(), py::arg("step"), py::arg("weights"), py::arg("offsets"),
+          py::arg("dist_idx"), py::arg("thresh"), py::arg("sigma"), py::arg("center"), py::arg("tiny"));
+  mod.def("prox_default_morph_stack", &prox_default_morph_stack<double, MatrixD, VectorD>,
+          "Fused default morphology proximal operator for a stack of morphologies",
+          py::arg("stack").noconvert(), py::arg("step"), py::arg("weights"), py::arg("offsets"),
+          py::arg("dist_idx"), py::arg("thresh"), py::arg("sigma"), py::arg("center"), py::arg("tiny"));
+
+  mod.def("prox_exact_monotonic", &prox_exact_monotonic<float, VectorF>,
+          "Exact Monotonic Proximal Operator", py::call_guard<py::gil_scoped_release>());
+  mod.def("prox_exact_monotonic", &prox_exact_monotonic<double, VectorD>,
+          "Exact Monotonic Proximal Operator", py::call_guard<py::gil_scoped_release>());
+
+  mod.def("apply_filter", &apply_filter<MatrixF, VectorF>, "Apply a filter to a 2D image",
+          py::call_guard<py::gil_scoped_release>());
+  mod.def("apply_filter", &apply_filter<MatrixD, VectorD>, "Apply a filter to a 2D image",
+          py::call_guard<py::gil_scoped_release>());
+
+  mod.def("apply_filters", &apply_filters<float>, "Apply a filter to each band of a 3D data cube",
+          py::arg("images"), py::arg("values"), py::arg("y_start"), py::arg("y_end"),
+          py::arg("x_start"), py::arg("x_end"), py::arg("filter_start"), py::arg("filter_stop"),
+          py::arg("result").noconvert());
+  mod.def("apply_filters", &apply_filters<double>, "Apply a filter to each band of a 3D data cube",
+          py::arg("images"), py::arg("values"), py::arg("y_start"), py::arg("y_end"),
+          py::arg("x_start"), py::arg("x_end"), py::arg("filter_start"), py::arg("filter_stop"),
+          py::arg("result").noconvert());
 
   return mod.ptr();
 }
@@ -161,10 +161,12 @@ class PointSource(Source):
         if shape is None:
             shape = (config.source_sizes[0],) * 2
         sed, morph = self._make_initial(center, img, shape)
+        sed, morph = sed.astype(config.dtype), morph.astype(config.dtype)
 
         if constraints is None:
             constraints = (sc.SimpleConstraint(),
-                           sc.DirectMonotonicityConstraint(use_nearest=False),
+                           sc.DirectMonotonicityConstraint(use_nearest=False, dtype=config.dtype,
+                                                           crop=config.crop_operators),
                            sc.DirectSymmetryConstraint())
 
         component = Component(sed, morph, center=center, constraints=constraints, psf=psf, fix_sed=fix_sed, fix_morph=fix_morph, fix_frame=fix_frame, shift_center=shift_center)
@@ -235,10 +237,12 @@ class ExtendedSource(Source):
             config = Config()
 
         sed, morph = self._make_initial(center, img, bg_rms, thresh=thresh, symmetric=symmetric, monotonic=monotonic, config=config)
+        sed, morph = sed.astype(config.dtype), morph.astype(config.dtype)
 
         if constraints is None:
             constraints = (sc.SimpleConstraint(),
-                           sc.DirectMonotonicityConstraint(use_nearest=False),
+                           sc.DirectMonotonicityConstraint(use_nearest=False, dtype=config.dtype,
+                                                           crop=config.crop_operators),
                            sc.DirectSymmetryConstraint())
 
         component = Component(sed, morph, center=center, constraints=constraints, psf=psf, fix_sed=fix_sed, fix_morph=fix_morph, fix_frame=fix_frame, shift_center=shift_center)
@@ -371,7 +375,8 @@ class MultiComponentSource(ExtendedSource):
 
         if constraints is None:
             constraints = (sc.SimpleConstraint(),
-                           sc.DirectMonotonicityConstraint(use_nearest=False),
+                           sc.DirectMonotonicityConstraint(use_nearest=False, dtype=config.dtype,
+                                                           crop=config.crop_operators),
                            sc.DirectSymmetryConstraint())
 
         # start from ExtendedSource for single-component morphology and sed
@@ -416,7 +421,8 @@ class MultiComponentSource(ExtendedSource):
         c = self.components[0]
         component_slice = c.get_slice_for(img.shape)
         S = np.array(morphs)[:,component_slice[1], component_slice[2]].reshape(K, -1)
-        seds = get_best_fit_sed(img[c.bb], S)
+        seds = get_best_fit_sed(img[c.bb], S).astype(config.dtype)
+        morphs = [morph.astype(config.dtype) for morph in morphs]
 
         for k in range(K):
             if k == 0:
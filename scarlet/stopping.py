@@ -0,0 +1,151 @@
+from __future__ import print_function, division
+from timeit import default_timer as timer
+
+import numpy as np
+
+import logging
+logger = logging.getLogger("scarlet.stopping")
+
+
+class StoppingPolicy(object):
+    """Policy to stop a fit (or parts of it) before it converges.
+
+    Policies are passed to `~scarlet.blend.Blend.fit` and are called after
+    every iteration. Besides stopping the fit they can also freeze components
+    with `~scarlet.blend.Blend.freeze`.
+    """
+    def reset(self, blend):
+        """Prepare the policy for a new call to `~scarlet.blend.Blend.fit`
+
+        Parameters
+        ----------
+        blend: `~scarlet.blend.Blend`
+            The blend that is fit.
+        """
+        pass
+
+    def __call__(self, blend, changes):
+        """Decide whether to stop the fit
+
+        Parameters
+        ----------
+        blend: `~scarlet.blend.Blend`
+            The blend that is fit, `blend.it` is the number of the iteration
+            that was just completed.
+        changes: `~numpy.array`
+            (K, 2) array of the relative changes `|X - X_prev|/|X|` of the SED
+            and morphology of each component in the iteration.
+
+        Returns
+        -------
+        stop: bool
+            Whether to stop the fit.
+        """
+        return False
+
+
+class Chi2Stopping(StoppingPolicy):
+    """Stop when the weighted chi^2 does not improve anymore
+
+    The fit is stopped when the relative improvement of the weighted chi^2
+    in an iteration is less than `e_rel` for `patience` consecutive iterations.
+    The chi^2 uses the `weights` passed to `~scarlet.blend.Blend.set_data`.
+    This requires an additional pass over the image in each iteration.
+    """
+    def __init__(self, e_rel=1e-4, patience=3):
+        """Initialize the policy
+
+        Parameters
+        ----------
+        e_rel: float
+            Minimum relative improvement of the chi^2 per iteration.
+        patience: int
+            Number of consecutive iterations without sufficient improvement
+            before the fit is stopped.
+        """
+        self.e_rel = e_rel
+        self.patience = patience
+
+    def reset(self, blend):
+        self.chi2 = None
+        self.count = 0
+
+    def __call__(self, blend, changes):
+        chi2 = blend._get_chi2()
+        if self.chi2 is not None and self.chi2 - chi2 < self.e_rel * chi2:
+            self.count += 1
+        else:
+            self.count = 0
+        self.chi2 = chi2
+        if self.count >= self.patience:
+            logger.info("chi^2 did not improve in {0} iterations, stopping at it {1}".format(self.count, blend.it))
+            return True
+        return False
+
+
+class WallClockStopping(StoppingPolicy):
+    """Stop when the fit exceeds a wall-clock budget
+    """
+    def __init__(self, seconds):
+        """Initialize the policy
+
+        Parameters
+        ----------
+        seconds: float
+            Maximum wall-clock time of a call to `~scarlet.blend.Blend.fit`.
+        """
+        self.seconds = seconds
+
+    def reset(self, blend):
+        self.start = timer()
+
+    def __call__(self, blend, changes):
+        if timer() - self.start > self.seconds:
+            logger.warning("exceeded wall-clock budget of {0} s, stopping at it {1}".format(self.seconds, blend.it))
+            return True
+        return False
+
+
+class FreezeConverged(StoppingPolicy):
+    """Freeze components once they have converged
+
+    A component is frozen (see `~scarlet.blend.Blend.freeze`) when the
+    relative changes of its SED and morphology are less than `e_rel`
+    in `patience` consecutive iterations. Frozen components still contribute
+    to the model, but their gradients and proximal operators are not computed
+    anymore. With `unfreeze_thresh`, frozen components are unfrozen when the
+    residuals in their bounding boxes change by more than `unfreeze_thresh`.
+    This policy never stops the fit.
+    """
+    def __init__(self, e_rel=None, patience=1, unfreeze_thresh=None):
+        """Initialize the policy
+
+        Parameters
+        ----------
+        e_rel: float, default=`None`
+            Relative change below which a component is converged.
+            If `e_rel` is `None`, the `e_rel` of `~scarlet.blend.Blend.fit` is used.
+        patience: int
+            Number of consecutive converged iterations before a component is frozen.
+        unfreeze_thresh: float, default=`None`
+            Relative change of the weighted residuals in the bounding box of
+            a frozen component above which it is unfrozen
+            (see `~scarlet.blend.Blend.freeze`).
+            If `unfreeze_thresh` is `None`, components stay frozen.
+        """
+        self.e_rel = e_rel
+        self.patience = patience
+        self.unfreeze_thresh = unfreeze_thresh
+
+    def reset(self, blend):
+        self.count = np.zeros(blend.K, dtype=int)
+
+    def __call__(self, blend, changes):
+        e_rel = blend.e_rel if self.e_rel is None else self.e_rel
+        converged = np.all(changes <= e_rel, axis=1)
+        self.count[converged] += 1
+        # an unfrozen component has to converge again before it is frozen
+        self.count[~converged | blend.frozen] = 0
+        for k in np.flatnonzero(self.count >= self.patience):
+            blend.freeze(k, unfreeze_thresh=self.unfreeze_thresh)
+        return False
@@ -0,0 +1,86 @@
+from __future__ import print_function, division
+
+import numpy as np
+
+import logging
+logger = logging.getLogger("scarlet.storage")
+
+
+class ParameterStore(object):
+    """Contiguous storage of the SEDs and morphologies of components
+
+    The SEDs of all components are stored in a single (K, B) array `sed`,
+    and the morphologies in one (N, Ny, Nx) stack for every frame shape in
+    `morphs`. Because the frames of the components are snapped to
+    `~scarlet.config.Config.source_sizes`, most components share a few shapes.
+    The `sed` and `morph` of each component are views into these arrays,
+    so that all SEDs or all morphologies with the same shape can be updated
+    with a single vectorized operation or handed to a native kernel without
+    copying them.
+
+    Assigning a new SED or morphology with the same shape to a component
+    copies it into the store. When a component is resized, the morphologies
+    are packed into new stacks (see `pack`), which invalidates previous views.
+    """
+    def __init__(self, components, dtype=None):
+        """Initialize the store
+
+        Parameters
+        ----------
+        components: list of `~scarlet.component.Component`
+            Components whose parameters are moved into the store.
+        dtype: `numpy.dtype`, default=`None`
+            Floating point type of the parameters.
+            If `dtype` is `None`, the type of the first SED is used.
+        """
+        self.components = tuple(components)
+        if dtype is None:
+            dtype = self.components[0].sed.dtype
+        self.dtype = np.dtype(dtype)
+        self.sed = np.empty((self.K, self.components[0].B), dtype=self.dtype)
+        for k, c in enumerate(self.components):
+            self.sed[k] = c.sed
+        for k, c in enumerate(self.components):
+            c._store = self
+            c._sed = self.sed[k]
+        self.pack()
+
+    @property
+    def K(self):
+        """Number of components in the store
+        """
+        return len(self.components)
+
+    def pack(self):
+        """Build the morphology stacks from the current morphologies
+
+        This is called by `~scarlet.component.Component` when the shape of its
+        morphology changes. The morphology of every component is rebound to a
+        view into the new stacks.
+        """
+        members = {}
+        for k, c in enumerate(self.components):
+            members.setdefault(c.morph.shape, []).append(k)
+        morphs = {}
+        for shape, ks in members.items():
+            morphs[shape] = np.empty((len(ks),) + shape, dtype=self.dtype)
+            for n, k in enumerate(ks):
+                morphs[shape][n] = self.components[k].morph
+        # only rebind the components after all morphologies are copied
+        for shape, ks in members.items():
+            for n, k in enumerate(ks):
+                self.components[k]._morph = morphs[shape][n]
+        self.morphs = morphs
+        self.members = members
+
+    def detach(self):
+        """Give every component its own copy of its SED and morphology
+        """
+        for c in self.components:
+            c._store = None
+            c._sed = c._sed.copy()
+            c._morph = c._morph.copy()
+        self.components = ()
+        self.sed = None
+        self.morphs = {}
+        self.members = {}
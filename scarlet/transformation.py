@@ -1,11 +1,17 @@
 from __future__ import print_function, division
 import warnings
+import hashlib
 
 import numpy as np
 import scipy.sparse
+import scipy.fftpack
 import proxmin.utils
 from .cache import Cache
 
+# Minimum number of non-zero kernel pixels to use FFT convolution
+# when a filter is set to choose automatically (`fft=None`)
+FFT_MIN_SIZE = 100
+
 def get_filter_slices(coords):
     """Get the slices in x and y to apply a filter
     """
@@ -24,7 +30,7 @@ class LinearFilter:
     This acts like a sparse diagonal matrix that applies an
     image of weights to a 2D matrix.
     """
-    def __init__(self, values, coords=None, center=None):
+    def __init__(self, values, coords=None, center=None, fft=None):
         """Initialize the Filter
 
         Parameters
@@ -50,6 +56,10 @@ class LinearFilter:
             current pixel is the upper right element, then
             `center=[0,0]` (`values=0`). If current pixel is the top right then
             `center=[0,1]` (`values=1`).
+        fft: bool, default=`None`
+            Whether to apply the filter with an FFT convolution
+            (see `apply_filters`). If `fft` is `None`, FFTs are used when
+            the filter has at least `FFT_MIN_SIZE` non-zero pixels.
         """
         if coords is None:
             # Attempt to automatically create coordinate grid
@@ -82,14 +92,82 @@ class LinearFilter:
         self._flat_values = self._flat_values[non_zero]
         self._flat_coords = self._flat_coords[non_zero]
         self._slices = get_filter_slices(self._flat_coords)
+        self._T = None
+        self.fft = fft
+        self._fft_key = None
 
     @property
     def T(self):
         """Transpose the filter
         """
-        return LinearFilter(self._flat_values, -self._flat_coords)
+        if self._T is None:
+            self._T = LinearFilter(self._flat_values, -self._flat_coords, fft=self.fft)
+            self._T._T = self
+        return self._T
+
+    @property
+    def size(self):
+        """Number of non-zero pixels in the filter
+        """
+        return len(self._flat_values)
+
+    @property
+    def use_fft(self):
+        """Whether the filter is applied with an FFT convolution
+        """
+        if self.fft is None:
+            return self.size >= FFT_MIN_SIZE
+        return self.fft
+
+    @property
+    def radius(self):
+        """Maximum offset (y,x) of a non-zero pixel from the current pixel
+        """
+        return np.abs(self._flat_coords).max(axis=0)
+
+    def get_fft(self, fft_shape):
+        """Fourier transform of the filter
+
+        The transform is the `numpy.fft.rfft2` of the filter kernel placed
+        with its current pixel at the origin of an array with shape `fft_shape`.
+        Transforms of large filters (like PSFs) are cached for every `fft_shape`,
+        since frames are restricted to `~scarlet.config.Config.source_sizes`
+        there is only a small number of different `fft_shape`s.
 
-    def dot(self, X):
+        Parameters
+        ----------
+        fft_shape: tuple
+            Shape (Height, Width) of the zero padded images.
+
+        Returns
+        -------
+        kernel_fft: `~numpy.array`
+            Complex array with shape `(Height, Width//2+1)`.
+        """
+        fft_shape = tuple(fft_shape)
+        if self.size < 16:
+            # sum of the phase shifts of each pixel: faster than an FFT
+            ky = np.fft.fftfreq(fft_shape[0])
+            kx = np.fft.rfftfreq(fft_shape[1])
+            ey = np.exp(-2j*np.pi*self._flat_coords[:,0,None]*ky[None,:])
+            ex = np.exp(-2j*np.pi*self._flat_coords[:,1,None]*kx[None,:])
+            return np.dot((self._flat_values[:,None] * ey).T, ex)
+
+        if self._fft_key is None:
+            self._fft_key = hashlib.sha1(np.ascontiguousarray(self._flat_values).tobytes() +
+                                         np.ascontiguousarray(self._flat_coords).tobytes()).hexdigest()
+        name = "LinearFilter.get_fft"
+        key = (self._fft_key, fft_shape)
+        try:
+            kernel_fft = Cache.check(name, key)
+        except KeyError:
+            kernel = np.zeros(fft_shape)
+            kernel[tuple((self._flat_coords % np.array(fft_shape)).T)] = self._flat_values
+            kernel_fft = np.fft.rfft2(kernel)
+            Cache.set(name, key, kernel_fft)
+        return kernel_fft
+
+    def dot(self, X, result=None):
         """Apply the filter to an image or combine filters
 
         Parameters
@@ -97,6 +175,9 @@ class LinearFilter:
         X: 2D numpy array or `LinearFilter` or `LinearFilterChain`
             Array to apply the filter to, or chain of filters to
             prepend this filter to.
+        result: 2D numpy array, default=`None`
+            Array with the same shape as `X` to store the result in.
+            If `result` is `None` a new array is allocated.
 
         Returns
         -------
@@ -114,8 +195,11 @@ class LinearFilter:
         elif isinstance(X, LinearFilterChain):
             X.filters.insert(0,self)
             return X
+        elif self.use_fft:
+            return apply_filters(self, X, result=None if result is None else result[None,:,:])[0]
         else:
-            result = np.empty(X.shape, dtype=X.dtype)
+            if result is None:
+                result = np.empty(X.shape, dtype=X.dtype)
             apply_filter(X, self._flat_values, self._slices[0], self._slices[1],
                                  self._slices[2], self._slices[3], result)
             return result
@@ -125,8 +209,13 @@ class LinearFilterChain:
 
     Because `LinearFilter` objects are not really arrays,
     this class keeps track of the order of a series of filters.
+    By default the filters are applied one after the other, and every
+    intermediate image is truncated at the edges of the frame.
+    With `fuse=True` the chain is fused into a single `LinearFilter`
+    (see `fused`), or the product of the Fourier transforms of all filters
+    is used (see `get_fft`), so the intermediate images are never created.
     """
-    def __init__(self, filters):
+    def __init__(self, filters, fft=None, fuse=False):
         """Initialize the class
 
         Parameters
@@ -135,8 +224,30 @@ class LinearFilterChain:
             List of `LinearFilter` objects, in the order from
             left to right. So the last element in `filters` is
             applied to an image first.
+        fft: bool, default=`None`
+            Whether to apply the chain with an FFT convolution.
+            If `fft` is `None`, FFTs are used when any of the
+            `filters` would use them (see `LinearFilter.use_fft`).
+        fuse: bool, default=`False`
+            Whether to apply the chain as a single fused filter.
+            This is faster, but it changes the result at the edges of the
+            frame, because flux that the first filters move out of the frame
+            is not truncated before the next filters are applied.
         """
         self.filters = filters
+        self.fft = fft
+        self.fuse = fuse
+        self._fused = None
+        self._T = None
+
+    @property
+    def _key(self):
+        """Identifier of the current list of filters
+
+        Used to invalidate the cached transpose and fused filter
+        whenever `self.filters` changes.
+        """
+        return tuple(id(f) for f in self.filters)
 
     @property
     def T(self):
@@ -145,9 +256,75 @@ class LinearFilterChain:
         Reverse the order and transpose each `LinearFilter` in
         `self.filters`.
         """
-        return LinearFilterChain([f.T for f in self.filters[::-1]])
+        if self._T is None or self._T[0] != self._key:
+            self._T = (self._key, LinearFilterChain([f.T for f in self.filters[::-1]], fft=self.fft,
+                                                             fuse=self.fuse))
+        return self._T[1]
+
+    @property
+    def size(self):
+        """Number of non-zero pixels of the largest filter in the chain
+        """
+        return max([f.size for f in self.filters])
+
+    @property
+    def use_fft(self):
+        """Whether the fused chain is applied with an FFT convolution
+        """
+        if self.fft is None:
+            return any([f.use_fft for f in self.filters])
+        return self.fft
+
+    @property
+    def radius(self):
+        """Maximum offset (y,x) of a non-zero pixel of the fused filter
+        """
+        return np.sum([f.radius for f in self.filters], axis=0)
+
+    def get_fft(self, fft_shape):
+        """Fourier transform of the chain
 
-    def dot(self, X):
+        See `LinearFilter.get_fft` for details.
+        """
+        kernel_fft = self.filters[0].get_fft(fft_shape)
+        for f in self.filters[1:]:
+            kernel_fft = kernel_fft * f.get_fft(fft_shape)
+        return kernel_fft
+
+    @property
+    def fused(self):
+        """Combine all filters into a single `LinearFilter`
+
+        The kernel of the fused filter is the convolution of the kernels
+        of all filters in the chain, e.g. the PSF kernel shifted by the
+        sub-pixel translation.
+        Contrary to applying the filters one after the other, the fused filter
+        does not truncate the intermediate images at the edges of the frame,
+        so it is only used with `fuse=True`.
+        """
+        if self._fused is None or self._fused[0] != self._key:
+            # dense kernel and the coordinates of its first pixel
+            kernel = np.ones((1,1))
+            origin = np.zeros(2, dtype=int)
+            for f in self.filters:
+                _origin = f._flat_coords.min(axis=0)
+                _kernel = np.zeros(f._flat_coords.max(axis=0) - _origin + 1)
+                _kernel[tuple((f._flat_coords - _origin).T)] = f._flat_values
+                # convolve the kernels by shifting the larger by every pixel of the smaller one
+                if np.count_nonzero(kernel) > len(f._flat_values):
+                    kernel, _kernel = _kernel, kernel
+                Ny, Nx = _kernel.shape
+                result = np.zeros((kernel.shape[0] + Ny - 1, kernel.shape[1] + Nx - 1))
+                for y, x in zip(*np.nonzero(kernel)):
+                    result[y:y+Ny, x:x+Nx] += kernel[y,x] * _kernel
+                kernel = result
+                origin += _origin
+            coords = np.argwhere(kernel != 0)
+            values = kernel[tuple(coords.T)]
+            self._fused = (self._key, LinearFilter(values, coords + origin))
+        return self._fused[1]
+
+    def dot(self, X, result=None):
         """Apply the filters
 
         Apply the filters in reverse order,
@@ -158,6 +335,9 @@ class LinearFilterChain:
         ----------
         X: 2D numpy array
             Image to apply the filters to.
+        result: 2D numpy array, default=`None`
+            Array with the same shape as `X` to store the result in.
+            If `result` is `None` a new array is allocated.
 
         Returns
         -------
@@ -172,12 +352,15 @@ class LinearFilterChain:
         elif isinstance(X, LinearFilterChain):
             for f in X.filters:
                 self.filters.append(f)
-        else:
+        elif not self.fuse:
             _filters = self.filters[::-1]
-            result = X
-            for f in _filters:
-                result = f.dot(result)
-            return result
+            for f in _filters[:-1]:
+                X = f.dot(X)
+            return _filters[-1].dot(X, result=result)
+        elif self.use_fft:
+            return apply_filters(self, X, result=None if result is None else result[None,:,:])[0]
+        else:
+            return self.fused.dot(X, result=result)
         return self
 
 class LinearTranslation(LinearFilter):
@@ -195,6 +378,9 @@ class LinearTranslation(LinearFilter):
             Fractional amount (from 0 to 1) to
             shift the image in the x-direction
         """
+        # only 4 pixels: direct application is always faster than an FFT
+        self.fft = False
+        self._fft_key = None
         self.set_transform(dy, dx)
 
     def set_transform(self, dy=0, dx=0):
@@ -211,6 +397,7 @@ class LinearTranslation(LinearFilter):
         """
         self.dy = dy
         self.dx = dx
+        self._T = None
         sign_x = 1 if dx>= 0 else -1
         sign_y = 1 if dy>= 0 else -1
         dx = abs(dx)
@@ -235,7 +422,95 @@ class LinearTranslation(LinearFilter):
     def T(self):
         """Transpose the filter
         """
-        return LinearTranslation(-self.dy, -self.dx)
+        if self._T is None:
+            self._T = LinearTranslation(-self.dy, -self.dx)
+            self._T._T = self
+        return self._T
+
+def apply_filters(filters, X, result=None):
+    """Apply filters to every band of a data cube
+
+    This is the batched version of `LinearFilter.dot` and
+    `LinearFilterChain.dot` for multi-band images: all bands are
+    filtered in a single call to `operators_pybind11.apply_filters`,
+    or, if any of the filters has `use_fft`, with a single (batched)
+    FFT convolution.
+    Chains without `fuse` are applied in one such call for every filter
+    in the chains, so that every intermediate image is truncated at the edges.
+
+    Parameters
+    ----------
+    filters: `LinearFilter` or `LinearFilterChain`, or list thereof
+        Either a single filter (or chain) that is applied to every band,
+        or a list with the filter (or chain) for each band.
+    X: 2D or 3D numpy array
+        (Bands, Height, Width) data cube to apply the filters to.
+        If `X` is a single (Height, Width) image, every filter in the list
+        `filters` is applied to it.
+    result: 3D numpy array, default=`None`
+        (Bands, Height, Width) array to store the result in.
+        If `result` is `None` a new array is allocated.
+
+    Returns
+    -------
+    result: 3D numpy array
+        The filtered data cube.
+    """
+    from .operators_pybind11 import apply_filters as _apply_filters
+
+    if len(X.shape) == 2:
+        X = X[None,:,:]
+    if isinstance(filters, (list, tuple)):
+        B = len(filters)
+    else:
+        B = len(X)
+        filters = [filters]
+    if result is None:
+        result = np.empty((B,) + X.shape[1:], dtype=X.dtype)
+
+    chains = [f for f in filters if isinstance(f, LinearFilterChain) and not f.fuse]
+    if len(chains):
+        # apply the chains one filter at a time
+        if len(chains) != len(filters) or len(set([len(f.filters) for f in chains])) != 1:
+            raise ValueError("Chains that are not fused must all have the same number of filters")
+        stages = []
+        for stage in zip(*[f.filters[::-1] for f in chains]):
+            if all([f is stage[0] for f in stage]):
+                # e.g. the translation, which is the same in every band
+                stages.append(stage[0])
+            else:
+                stages.append(list(stage))
+        for stage in stages[:-1]:
+            X = apply_filters(stage, X)
+        if not isinstance(stages[-1], list) and len(X) != B:
+            # a single image is filtered with the same filters in every band
+            stages[-1] = [stages[-1]] * B
+        return apply_filters(stages[-1], X, result=result)
+
+    if any([f.use_fft for f in filters]):
+        # pad the images to avoid that the circular convolution wraps around
+        Ny, Nx = X.shape[1:]
+        radius = np.max([f.radius for f in filters], axis=0)
+        fft_shape = (scipy.fftpack.next_fast_len(int(Ny + radius[0])),
+                     scipy.fftpack.next_fast_len(int(Nx + radius[1])))
+        # keep the precision of X (complex64 for single precision images)
+        kernel_fft = np.array([f.get_fft(fft_shape) for f in filters],
+                              dtype=np.result_type(X.dtype, np.complex64))
+        X_fft = np.fft.rfft2(X, s=fft_shape)
+        result[:] = np.fft.irfft2(X_fft * kernel_fft, s=fft_shape)[:, :Ny, :Nx]
+        return result
+
+    filters = [f.fused if isinstance(f, LinearFilterChain) else f for f in filters]
+    sizes = np.array([len(f._flat_values) for f in filters])
+    if len(filters) == 1:
+        stop = np.repeat(sizes, B)
+    else:
+        stop = np.cumsum(sizes)
+    start = stop - sizes
+    values = np.concatenate([f._flat_values for f in filters])
+    slices = [np.concatenate([f._slices[i] for f in filters]) for i in range(4)]
+    _apply_filters(X, values, slices[0], slices[1], slices[2], slices[3], start, stop, result)
+    return result
 
 class Gamma:
     """Combination of Linear (x,y) Transformation and PSF Convolution
@@ -246,7 +521,7 @@ class Gamma:
     Gamma = Ty.P.Tx, where Tx,Ty are the translation operators and P is the PSF
     convolution operator.
     """
-    def __init__(self, psfs=None, center=None, dy=0, dx=0):
+    def __init__(self, psfs=None, center=None, dy=0, dx=0, fft=None, fuse=False):
         """Constructor
 
         Parameters
@@ -262,8 +537,20 @@ class Gamma:
             Fractional shift in the y direction
         dx: float
             Fractional shift in the x direction
+        fft: bool, default=`None`
+            Whether to convolve with the `psfs` using FFTs.
+            If `fft` is `None`, FFTs are used for PSFs with at least
+            `FFT_MIN_SIZE` non-zero pixels, otherwise the PSF is applied
+            directly as a sum of shifted images.
+        fuse: bool, default=`False`
+            Whether the translation and the PSF convolution are fused into a
+            single filter (see `LinearFilterChain`). This is faster, but the
+            translated image is not truncated at the edges of the frame before
+            the PSF convolution, which changes the models at the edges.
         """
         self.psfs = psfs
+        self.fft = fft
+        self.fuse = fuse
 
         # Create the PSF filter for each band
         if psfs is not None:
@@ -280,7 +567,7 @@ class Gamma:
         """
         self.psfFilters = []
         for psf in psfs:
-            self.psfFilters.append(LinearFilter(psf, center=center))
+            self.psfFilters.append(LinearFilter(psf, center=center, fft=self.fft))
 
     def _update_translation(self, dy=0, dx=0):
         """Update the translation filter
@@ -322,7 +609,8 @@ class Gamma:
         else:
             gamma = []
             for b in range(self.B):
-                gamma.append(LinearFilterChain([translation, self.psfFilters[b]]))
+                gamma.append(LinearFilterChain([translation, self.psfFilters[b]], fft=self.fft,
+                                               fuse=self.fuse))
         return gamma
 
 def getPSFOp(psf, imgShape):
@@ -335,7 +623,7 @@ def getPSFOp(psf, imgShape):
 
     warnings.warn("The 'psfOp' is deprecated, use 'LinearFilter' instead")
     name = "getPSFOp"
-    key = tuple(imgShape)
+    key = tuple(imgShape) + (hashlib.sha1(np.ascontiguousarray(psf).tobytes()).hexdigest(),)
     try:
         psfOp = Cache.check(name, key)
     except KeyError:
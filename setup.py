@@ -77,12 +77,40 @@ def has_flag(compiler, flagname):
     the specified compiler.
     """
     import tempfile
-    with tempfile.NamedTemporaryFile('w', suffix='.cpp') as f:
-        f.write('int main (int argc, char **argv) { return 0; }')
+    import shutil
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'test.cpp')
+        with open(filename, 'w') as f:
+            f.write('int main (int argc, char **argv) { return 0; }')
         try:
-            compiler.compile([f.name], extra_postargs=[flagname])
+            # write the object file into the temporary directory, not the working directory
+            compiler.compile([filename], output_dir=tmpdir, extra_postargs=[flagname])
         except setuptools.distutils.errors.CompileError:
             return False
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return True
+
+
+def has_openmp(compiler):
+    """Return a boolean indicating whether the specified compiler can
+    compile *and* link a program with OpenMP.
+    """
+    import tempfile
+    import shutil
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'test.cpp')
+        with open(filename, 'w') as f:
+            f.write('int main (int argc, char **argv) { return 0; }')
+        try:
+            objects = compiler.compile([filename], output_dir=tmpdir, extra_postargs=['-fopenmp'])
+            compiler.link_executable(objects, os.path.join(tmpdir, 'test'), extra_postargs=['-fopenmp'])
+        except (setuptools.distutils.errors.CompileError, setuptools.distutils.errors.LinkError):
+            return False
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
     return True
 
 
@@ -111,15 +139,22 @@ class BuildExt(build_ext):
     def build_extensions(self):
         ct = self.compiler.compiler_type
         opts = self.c_opts.get(ct, [])
+        link_opts = []
         if ct == 'unix':
             opts.append('-DVERSION_INFO="%s"' % self.distribution.get_version())
             opts.append(cpp_flag(self.compiler))
             if has_flag(self.compiler, '-fvisibility=hidden'):
                 opts.append('-fvisibility=hidden')
+            if has_openmp(self.compiler):
+                # parallelize the operators for stacks of morphologies,
+                # without OpenMP they are applied serially
+                opts.append('-fopenmp')
+                link_opts.append('-fopenmp')
         elif ct == 'msvc':
             opts.append('/DVERSION_INFO=\\"%s\\"' % self.distribution.get_version())
         for ext in self.extensions:
             ext.extra_compile_args = opts
+            ext.extra_link_args = link_opts
         build_ext.build_extensions(self)
 
 install_requires = ['numpy', 'scipy', 'proxmin>=0.5.2']
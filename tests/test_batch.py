@@ -0,0 +1,133 @@
+import os
+
+import numpy as np
+import pytest
+
+import scarlet
+from scarlet import batch
+
+DATA = os.path.join(os.path.dirname(__file__), "..", "data", "real_data", "hsc_cosmos", "43158172147386355.npz")
+
+
+def get_footprint():
+    data = np.load(DATA)
+    images = data["images"]
+    bg_rms = np.sqrt(np.std(images, axis=(1,2))**2 + np.median(images, axis=(1,2))**2)
+    peaks = [(peak[1], peak[0]) for peak in data["peaks"]]
+    return images, peaks, data["weights"], bg_rms
+
+
+def test_run_blends_skips_bad_sources():
+    images, peaks, weights, bg_rms = get_footprint()
+    models, converged, errors = scarlet.run_blends([(images, peaks, weights, bg_rms)], processes=1, steps=20)
+    # the peak at (36, 52) has no flux above the threshold
+    failed = [i for i, error in enumerate(errors[0]) if error is not None]
+    assert failed == [peaks.index((36, 52))]
+    assert isinstance(errors[0][failed[0]], scarlet.source.SourceInitError)
+    assert len(models[0]) == len(peaks) - 1
+    assert len(converged[0]) == len(peaks) - 1
+
+
+def test_run_blends_processes():
+    images, peaks, weights, bg_rms = get_footprint()
+    cutout = (slice(None), slice(0, 40), slice(0, 40))
+    footprints = [
+        (images, peaks, weights, bg_rms),
+        # every source of this footprint fails to initialize without a background RMS
+        (images, peaks, weights, None),
+        (images[cutout], [p for p in peaks if p[0] < 40 and p[1] < 40], weights[cutout], bg_rms),
+    ]
+    serial = scarlet.run_blends(footprints, processes=1, steps=20)
+    parallel = scarlet.run_blends(footprints, processes=2, steps=20)
+    single = scarlet.run_blends(footprints[:1], processes=1, steps=20)
+
+    for results in [serial, parallel]:
+        models, converged, errors = results
+        assert models[1] is None and converged[1] is None
+        assert len(errors[1]) == len(peaks)
+        assert all(isinstance(error, TypeError) for error in errors[1])
+        # the failed footprint does not affect the others
+        np.testing.assert_array_equal(models[0], single[0][0])
+        np.testing.assert_array_equal(converged[0], single[1][0])
+    for index in [0, 2]:
+        np.testing.assert_array_equal(serial[0][index], parallel[0][index])
+        np.testing.assert_array_equal(serial[1][index], parallel[1][index])
+        assert [type(e) for e in serial[2][index]] == [type(e) for e in parallel[2][index]]
+
+
+def get_scene(shape=(40, 100), peaks=[(20, 20), (20, 50), (20, 80)]):
+    """Three isolated Gaussian sources with a small amount of noise"""
+    y, x = np.mgrid[:shape[0], :shape[1]]
+    seds = np.array([[1, 2, 3], [3, 2, 1], [2, 2, 2]], dtype=float)
+    images = np.zeros((3,) + shape)
+    for (py, px), sed in zip(peaks, seds):
+        images += sed[:, None, None] * np.exp(-((y-py)**2 + (x-px)**2) / 8.)[None]
+    images += np.random.RandomState(0).normal(scale=0.01, size=images.shape)
+    return images, peaks
+
+
+@pytest.mark.parametrize("shape,tile_size,overlap", [((69, 57), 20, 5), ((100, 40), 32, 0), ((10, 10), 50, 20)])
+def test_get_tiles(shape, tile_size, overlap):
+    tiles = batch.get_tiles(shape, tile_size, overlap)
+    cores = np.zeros(shape, dtype=int)
+    covered = np.zeros(shape, dtype=bool)
+    for core, tile in tiles:
+        cores[core[0]:core[1], core[2]:core[3]] += 1
+        covered[tile[0]:tile[1], tile[2]:tile[3]] = True
+        assert tile[0] == max(core[0]-overlap, 0) and tile[1] == min(core[1]+overlap, shape[0])
+        assert tile[2] == max(core[2]-overlap, 0) and tile[3] == min(core[3]+overlap, shape[1])
+    # the cores partition the image, so every peak has exactly one owner
+    assert np.all(cores == 1)
+    assert np.all(covered)
+
+
+def test_run_tiles():
+    images, peaks = get_scene()
+    bg_rms = np.array([0.01]*3)
+    config = scarlet.Config(source_sizes=[15, 25])
+    # every source is in a different tile
+    output, converged, errors = scarlet.run_tiles(images, peaks, bg_rms=bg_rms, tile_size=34,
+                                                  processes=1, config=config, e_rel=1e-3)
+    assert errors == [None]*3
+    assert np.all(converged)
+
+    sources = [scarlet.ExtendedSource(peak, images, bg_rms, config=config) for peak in peaks]
+    blend = scarlet.Blend(sources).set_data(images, bg_rms=bg_rms, config=config)
+    blend.fit(200, e_rel=1e-3)
+    model = blend.get_model()
+    # compare the models around the peaks, away from the tile edges
+    for py, px in peaks:
+        cutout = (slice(None), slice(py-8, py+9), slice(px-8, px+9))
+        np.testing.assert_allclose(output[cutout], model[cutout], atol=1e-2*model.max())
+
+    # the background RMS is estimated in each tile when it is not given
+    np.testing.assert_allclose(batch.estimate_bg_rms(images), bg_rms, rtol=0.05)
+    _output, _, _ = scarlet.run_tiles(images, peaks, tile_size=34, processes=1, config=config, e_rel=1e-3)
+    np.testing.assert_allclose(_output, output, atol=1e-2*model.max())
+
+
+def test_run_tiles_bad_source():
+    images, peaks, weights, bg_rms = get_footprint()
+    images = images.astype(np.float32)
+    config = scarlet.Config(dtype=np.float32)
+    tile_size = 35
+    output, converged, errors = scarlet.run_tiles(images, peaks, weights=weights, bg_rms=bg_rms, config=config,
+                                                  tile_size=tile_size, processes=1, steps=20)
+    assert output.dtype == np.float32
+    bad = peaks.index((36, 52))
+    assert isinstance(errors[bad], scarlet.source.SourceInitError)
+    assert not np.any(converged[bad])
+    assert all(error is None for i, error in enumerate(errors) if i != bad)
+    # the other sources in the tile of the bad source are still deblended
+    neighbors = [(int(y), int(x)) for i, (y, x) in enumerate(peaks)
+                 if i != bad and y//tile_size == peaks[bad][0]//tile_size and x//tile_size == peaks[bad][1]//tile_size]
+    assert len(neighbors) > 0
+    for y, x in neighbors:
+        assert np.all(output[:, y, x] > 0)
+
+
+def test_run_tiles_failed():
+    images, peaks = get_scene()
+    # there is no flux above this background in any of the tiles
+    with pytest.raises(RuntimeError):
+        scarlet.run_tiles(images, peaks, bg_rms=np.array([100.]*3), tile_size=34, processes=1)
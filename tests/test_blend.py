@@ -0,0 +1,323 @@
+import os
+
+import numpy as np
+import pytest
+
+import scarlet
+from scarlet import stopping
+from scarlet.cache import Cache
+
+DATA = os.path.join(os.path.dirname(__file__), "..", "data", "real_data", "hsc_cosmos", "43158172147386355.npz")
+
+
+def get_blend(dtype=np.float64, weights=True, config=None):
+    data = np.load(DATA)
+    images = data["images"].astype(dtype)
+    bg_rms = np.sqrt(np.std(images, axis=(1,2))**2 + np.median(images, axis=(1,2))**2)
+    if config is None:
+        config = scarlet.Config(dtype=dtype)
+    sources = []
+    for peak in data["peaks"]:
+        try:
+            sources.append(scarlet.ExtendedSource((peak[1], peak[0]), images, bg_rms, config=config))
+        except scarlet.source.SourceInitError:
+            pass
+    _weights = data["weights"] if weights else None
+    blend = scarlet.Blend(sources).set_data(images, weights=_weights, bg_rms=bg_rms, config=config)
+    return blend, images, (data["weights"] if weights else np.ones(images.shape))
+
+
+def get_chi2(blend, images, weights):
+    return np.sum(weights * (blend.get_model() - images)**2)
+
+
+def record_chi2(blend, images, weights):
+    """Record the chi^2 at the beginning of every iteration with the profiling callback"""
+    chi2 = [get_chi2(blend, images, weights)]
+    loss = []
+    def callback(blend, _loss, timings):
+        loss.append(_loss)
+        # the model at the end of an iteration is the model of the next iteration
+        chi2.append(get_chi2(blend, images, weights))
+    blend.set_profiling(enabled=False, callback=callback)
+    return chi2, loss
+
+
+@pytest.mark.parametrize("weights", [True, False])
+def test_history_chi2(weights):
+    blend, images, _weights = get_blend(weights=weights)
+    chi2, loss = record_chi2(blend, images, _weights)
+    blend.set_history()
+    blend.fit(20, e_rel=1e-3)
+    assert len(blend.history) == blend.it
+    np.testing.assert_allclose(blend.history.chi2, chi2[:-1], rtol=1e-6)
+
+
+def test_callback_loss():
+    blend, images, weights = get_blend()
+    chi2, loss = record_chi2(blend, images, weights)
+    blend.fit(10, e_rel=1e-3)
+    assert len(loss) == blend.it
+    # negative log-likelihood of the model at the beginning of each iteration
+    np.testing.assert_allclose(loss, 0.5*np.array(chi2[:-1]), rtol=1e-6)
+
+
+@pytest.mark.parametrize("patience", [1, 2])
+def test_chi2_stopping(patience):
+    e_rel = 1e-3
+    blend, images, weights = get_blend()
+    chi2, loss = record_chi2(blend, images, weights)
+    blend.fit(200, e_rel=1e-6, stopping=stopping.Chi2Stopping(e_rel=e_rel, patience=patience))
+    # the policy sees the chi^2 of the model at the beginning of the iteration, which is
+    # `chi2[it-1]`, so it stops after `patience` iterations in which it improved by less than `e_rel`
+    count = 0
+    for it in range(1, len(chi2)):
+        if chi2[it-1] - chi2[it] < e_rel * chi2[it]:
+            count += 1
+        else:
+            count = 0
+        if count >= patience:
+            break
+    assert blend.it == it + 1
+    assert blend.it < 200
+
+
+def test_single_precision():
+    models = {}
+    for dtype in [np.float64, np.float32]:
+        blend, images, weights = get_blend(dtype=dtype)
+        blend.fit(30, e_rel=1e-3)
+        models[dtype] = blend.get_model()
+        assert blend._model.dtype == dtype
+        assert blend._diff.dtype == dtype
+        for c in blend.components:
+            assert c.sed.dtype == dtype
+            assert c.morph.dtype == dtype
+        assert models[dtype].dtype == dtype
+    norm = np.abs(models[np.float64]).max()
+    np.testing.assert_allclose(models[np.float32], models[np.float64], atol=1e-5*norm)
+
+
+@pytest.mark.parametrize("crop_operators", [False, True])
+def test_prepare_operators(crop_operators):
+    config = scarlet.Config(crop_operators=crop_operators)
+    blend, images, weights = get_blend(config=config)
+    Cache.clear()
+    config.prepare_operators()
+    before = Cache.stats()
+    blend.fit(100, e_rel=1e-3)
+    after = Cache.stats()
+    # the components are resized to rectangular frames
+    assert any(c.morph.shape[0] != c.morph.shape[1] for c in blend.components)
+    for name in before:
+        assert after[name]["misses"] == before[name]["misses"], name
+
+
+def test_parameter_store():
+    models = {}
+    for parameter_store in [False, True]:
+        blend, images, weights = get_blend(config=scarlet.Config(parameter_store=parameter_store))
+        blend.fit(100, e_rel=1e-3)
+        models[parameter_store] = blend.get_model()
+    store = blend._store
+    # the components were resized during the fit and are still views into the store
+    assert len(store.morphs) > 1
+    for k, c in enumerate(blend.components):
+        assert np.shares_memory(c.sed, store.sed[k])
+        n = store.members[c.morph.shape].index(k)
+        assert np.shares_memory(c.morph, store.morphs[c.morph.shape][n])
+    np.testing.assert_allclose(models[True], models[False], rtol=0, atol=1e-10*np.abs(models[False]).max())
+
+
+def test_batch_key():
+    blend, images, weights = get_blend()
+    keys = [c.constraints.batch_key for c in blend.components]
+    shapes = [c.morph.shape for c in blend.components]
+    assert all(key is not None for key in keys)
+    # components with the same shape have separate but equal constraints
+    for key, shape in zip(keys, shapes):
+        assert (keys.count(key) == shapes.count(shape))
+    # the key does not depend on the cached operator objects
+    Cache.clear()
+    for c, key in zip(blend.components, keys):
+        c.constraints.reset()
+        assert c.constraints.batch_key == key
+    # other parameters of the constraints result in a different key
+    c = blend.components[0]
+    c.set_constraints([scarlet.SimpleConstraint(), scarlet.DirectMonotonicityConstraint(thresh=0.1),
+                       scarlet.DirectSymmetryConstraint()])
+    assert c.constraints.batch_key not in keys
+    c.set_constraints([scarlet.SimpleConstraint(), scarlet.DirectMonotonicityConstraint(use_nearest=True),
+                       scarlet.DirectSymmetryConstraint()])
+    assert c.constraints.batch_key is None
+
+
+def test_batch_prox():
+    models = {}
+    for batch_prox in [False, True]:
+        blend, images, weights = get_blend(config=scarlet.Config(batch_prox=batch_prox))
+        blend.fit(100, e_rel=1e-3)
+        models[batch_prox] = blend.get_model()
+    np.testing.assert_allclose(models[True], models[False], rtol=0, atol=1e-10*np.abs(models[False]).max())
+
+
+def test_power_iteration():
+    rng = np.random.RandomState(5)
+    M = rng.rand(20, 10)
+    M = M.T.dot(M)
+    L = np.linalg.norm(M, 2)
+    value, x = scarlet.blend.power_iteration(M.dot, np.ones(10), e_rel=1e-3)
+    # the estimate converges from below
+    assert L*(1-1e-3) <= value <= L
+    np.testing.assert_allclose(M.dot(x), L*x, rtol=0, atol=0.1*L)
+    # warm start from the eigenvector
+    value, _x = scarlet.blend.power_iteration(M.dot, x, e_rel=1e-10)
+    np.testing.assert_allclose(value, L, rtol=1e-10)
+
+
+def test_lipschitz():
+    blend, images, weights = get_blend()
+    e_rel = blend.config.slack / 100
+    for it in range(3):
+        blend.fit(5, e_rel=1e-6)
+        # the step sizes are computed from the models at the beginning of the last iteration
+        S = np.zeros((blend.K,) + images.shape)
+        for k in range(blend.K):
+            S[k][blend._bbs[k]] = blend._models[k]
+        S = S.mean(axis=1).reshape(blend.K, -1)
+        for block, L in enumerate([np.linalg.norm(S, 2)**2, np.linalg.norm(blend._A, 2)**2]):
+            step = blend._one_over_lipschitz(block)
+            assert 1/(L*(1+e_rel)**2) <= step <= 1/L
+
+
+def test_recenter_components():
+    blend, images, weights = get_blend(config=scarlet.Config(center_min_dist=0))
+    blend.fit(5, e_rel=1e-6)
+    # dense least squares fit of the shifts of all components in the full frame
+    MT = []
+    updated = []
+    for k, c in enumerate(blend.components):
+        diff_x, diff_y = blend._get_shift_differential(k)
+        if blend.frozen[k] or np.sum(diff_x) == 0 or np.sum(diff_y) == 0:
+            continue
+        diff_x[:,:,-1] = 0
+        diff_y[:,-1,:] = 0
+        for diff in [diff_x, diff_y]:
+            _diff = np.zeros(images.shape)
+            _diff[blend._bbs[k]] = diff
+            MT.append(_diff.flatten())
+        updated.append(k)
+    MT = np.array(MT)
+    y = blend._weights[1] * (blend._model - blend._img)
+    expected = np.dot(np.dot(np.linalg.inv(np.dot(MT, MT.T)), MT), y.flatten())
+
+    centers = [c.center.copy() for c in blend.components]
+    blend._recenter_components()
+    shifts = np.array([(blend.components[k].center - centers[k])[::-1] for k in updated]).flatten()
+    assert len(updated) > 1
+    np.testing.assert_allclose(shifts, expected, rtol=0, atol=1e-12)
+
+
+def get_full_models(blend, use_sed=True):
+    """Model of every component in the full frame, computed from scratch"""
+    models = np.zeros((blend.K,) + blend._img.shape)
+    for k, c in enumerate(blend.components):
+        model = c.get_model(use_sed=use_sed)[c.get_slice_for(blend._img.shape)]
+        bottom, left = max(0, c.bottom), max(0, c.left)
+        models[k][:, bottom:bottom+model.shape[1], left:left+model.shape[2]] = model
+    return models
+
+
+@pytest.mark.parametrize("refine_skip", [10, 1000])
+def test_incremental_model(refine_skip):
+    blend, images, weights = get_blend(config=scarlet.Config(refine_skip=refine_skip))
+    compute_model = blend._compute_model
+    update_box_model = blend._update_box_model
+    errors = []
+    updates = []
+    def _update_box_model(k, morph_changed):
+        update_box_model(k, morph_changed)
+        updates[-1] += 1
+    def _compute_model():
+        updates.append(0)
+        compute_model()
+        expected = get_full_models(blend)
+        norm = np.abs(expected).max()
+        errors.append(np.abs(blend._model - expected.sum(axis=0)).max() / norm)
+        for k in range(blend.K):
+            _model = np.zeros(images.shape)
+            _model[blend._bbs[k]] = blend._A[:,k,None,None] * blend._models[k]
+            errors.append(np.abs(_model - expected[k]).max() / norm)
+    blend._compute_model = _compute_model
+    blend._update_box_model = _update_box_model
+    # frozen components do not change, so the model is updated incrementally
+    blend.fit(100, e_rel=1e-3, stopping=stopping.FreezeConverged(e_rel=1e-2))
+    assert any(0 < n < blend.K/2 for n in updates)
+    assert np.max(errors) < 1e-12
+
+
+def test_get_overlaps():
+    blend, images, weights = get_blend()
+    blend.fit(20, e_rel=1e-3)
+    overlaps = dict(((k, l), (slice_k, slice_l)) for k, l, slice_k, slice_l in blend._get_overlaps())
+    masks = np.zeros((blend.K,) + images.shape[1:], dtype=bool)
+    for k, bb in enumerate(blend._bbs):
+        masks[k][bb[1:]] = True
+    for k in range(blend.K):
+        for l in range(k, blend.K):
+            overlap = masks[k] & masks[l]
+            assert ((k, l) in overlaps) == np.any(overlap)
+            if np.any(overlap):
+                slice_k, slice_l = overlaps[(k, l)]
+                # the slices cover the same pixels in the full frame
+                full_k = np.zeros(images.shape[1:], dtype=bool)
+                full_k[blend._bbs[k][1:]][slice_k[1:]] = True
+                full_l = np.zeros(images.shape[1:], dtype=bool)
+                full_l[blend._bbs[l][1:]][slice_l[1:]] = True
+                np.testing.assert_array_equal(full_k, overlap)
+                np.testing.assert_array_equal(full_l, overlap)
+
+
+def get_parameters(blend):
+    return [c.sed.copy() for c in blend.components] + [c.morph.copy() for c in blend.components]
+
+
+def get_partially_fixed_blend():
+    """Blend in which most components are fixed, so that the model is updated incrementally"""
+    blend, images, weights = get_blend()
+    for c in blend.components[:-2]:
+        c.fix_sed = c.fix_morph = True
+    return blend, images, weights
+
+
+def test_checkpoint(tmpdir):
+    path = str(tmpdir.join("checkpoint.npz"))
+    blend, images, weights = get_partially_fixed_blend()
+    blend.fit(30, e_rel=1e-6)
+    expected = get_parameters(blend)
+
+    # saving the state does not change the fit
+    results = []
+    for save in [False, True]:
+        blend, images, weights = get_partially_fixed_blend()
+        blend.fit(15, e_rel=1e-6)
+        if save:
+            model_it = blend._model_it
+            blend.save_state(path)
+            assert blend._model_it == model_it
+        blend.fit(15, e_rel=1e-6)
+        results.append(get_parameters(blend))
+    for x, _x in zip(*results):
+        np.testing.assert_array_equal(x, _x)
+
+    # a fit resumed from a checkpoint is identical to the uninterrupted fit
+    blend, images, weights = get_partially_fixed_blend()
+    # (the model is rebuilt from scratch every `refine_skip=10` iterations, but not at a checkpoint)
+    blend.fit(21, e_rel=1e-6, checkpoint_every=7, checkpoint_path=path)
+    blend, images, weights = get_partially_fixed_blend()
+    blend.load_state(path)
+    assert blend.it == 21
+    blend.fit(9, e_rel=1e-6)
+    assert blend.it == 30
+    for x, _x in zip(get_parameters(blend), expected):
+        np.testing.assert_array_equal(x, _x)
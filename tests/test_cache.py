@@ -0,0 +1,152 @@
+import glob
+import os
+
+import numpy as np
+import proxmin
+import pytest
+from scipy import sparse
+
+from scarlet.cache import Cache
+
+
+@pytest.fixture
+def cache():
+    """Memory-only cache that is cleared after the test"""
+    directory = Cache.directory
+    Cache.set_directory(None)
+    yield Cache
+    Cache.clear()
+    Cache._limits.pop("test", None)
+    Cache.set_directory(directory)
+
+
+def test_lru_eviction(cache):
+    Cache.set_limit("test", 3*800)
+    for key in range(3):
+        Cache.set("test", key, np.zeros(100))
+    # use the first entry, so that the second one is the least recently used
+    Cache.check("test", 0)
+    Cache.set("test", 3, np.zeros(100))
+    assert list(Cache._cache["test"].keys()) == [2, 0, 3]
+    with pytest.raises(KeyError):
+        Cache.check("test", 1)
+    stats = Cache.stats()["test"]
+    assert stats["entries"] == 3
+    assert stats["bytes"] == 3*800
+    assert stats["evictions"] == 1
+
+    # a new entry is kept even if it is larger than the limit
+    Cache.set("test", 4, np.zeros(1000))
+    assert list(Cache._cache["test"].keys()) == [4]
+    assert Cache.stats()["test"]["evictions"] == 4
+
+
+def test_limits(cache):
+    assert Cache._limits["DirectMonotonicityConstraint.prox_morph_crop"] == 2**25
+    Cache.set_limit("test", None)
+    for key in range(10):
+        Cache.set("test", key, np.zeros(1000))
+    assert Cache.stats()["test"]["entries"] == 10
+    Cache.set_limit("test", 8000)
+    Cache.set("test", 10, np.zeros(1000))
+    assert Cache.stats()["test"]["entries"] == 1
+
+
+def test_stats(cache):
+    Cache.set("test", "a", np.zeros(10))
+    Cache.set("test", "b", [np.zeros(10), np.zeros((2, 5))])
+    Cache.check("test", "a")
+    Cache.check("test", "b")
+    Cache.check("test", "a")
+    for key in ["c", "d"]:
+        with pytest.raises(KeyError):
+            Cache.check("test", key)
+    stats = Cache.stats()["test"]
+    assert stats == {"hits": 3, "misses": 2, "evictions": 0, "disk_hits": 0, "disk_writes": 0,
+                     "entries": 2, "bytes": 80 + 160}
+    Cache.clear("test")
+    assert "test" not in Cache.stats()
+
+
+@pytest.fixture
+def disk_cache(tmpdir):
+    """Cache with a temporary directory that is cleared after the test"""
+    directory = Cache.directory
+    Cache.set_directory(str(tmpdir))
+    yield Cache
+    Cache.clear()
+    Cache.set_directory(directory)
+
+
+@pytest.mark.parametrize("content", [
+    np.arange(10.),
+    (np.arange(3), np.ones((2, 2), dtype=np.float32)),
+    [np.arange(3), np.zeros(0)],
+    sparse.random(10, 8, density=0.2, format="csr", random_state=0),
+])
+def test_disk_round_trip(disk_cache, content):
+    Cache.set("test", ("key", 1), content)
+    assert Cache.stats()["test"]["disk_writes"] == 1
+    # remove the content from memory, so that it is loaded from disk
+    Cache.clear("test")
+    result = Cache.check("test", ("key", 1))
+    assert Cache.stats()["test"]["disk_hits"] == 1
+    assert type(result) == type(content) or isinstance(content, np.ndarray)
+    if isinstance(content, (list, tuple)):
+        assert len(result) == len(content)
+        for r, c in zip(result, content):
+            assert r.dtype == c.dtype
+            np.testing.assert_array_equal(r, c)
+    elif sparse.issparse(content):
+        assert result.format == content.format
+        np.testing.assert_array_equal(result.toarray(), content.toarray())
+    else:
+        np.testing.assert_array_equal(result, content)
+
+
+def test_disk_matrix_adapter(disk_cache):
+    L = proxmin.utils.MatrixAdapter(sparse.identity(5, format="csr"), axis=1)
+    L.spectral_norm
+    Cache.set("test", "L", L)
+    Cache.clear("test")
+    result = Cache.check("test", "L")
+    assert isinstance(result, proxmin.utils.MatrixAdapter)
+    assert result.axis == 1
+    assert result._spec_norm == L._spec_norm
+    np.testing.assert_array_equal(result.L.toarray(), L.L.toarray())
+
+
+def test_disk_memory_only(disk_cache):
+    # functions are only cached in memory
+    Cache.set("test", "f", np.sum)
+    assert Cache.stats()["test"]["disk_writes"] == 0
+    Cache.clear("test")
+    with pytest.raises(KeyError):
+        Cache.check("test", "f")
+
+
+@pytest.mark.parametrize("content", [np.arange(100.), (np.arange(100.), np.arange(5))])
+@pytest.mark.parametrize("truncate", [0, 10, -10])
+def test_disk_corrupt_file(disk_cache, content, truncate):
+    Cache.set("test", "key", content)
+    path = glob.glob(os.path.join(Cache.directory, "test", "*"))[0]
+    with open(path, "rb") as f:
+        data = f.read()
+    # an empty, partially written or corrupt file
+    with open(path, "wb") as f:
+        f.write(data[:truncate] if truncate else b"not a numpy file")
+    Cache.clear("test")
+    with pytest.raises(KeyError):
+        Cache.check("test", "key")
+    assert Cache.stats()["test"]["misses"] == 1
+    assert not os.path.exists(path)
+    # the file is written again
+    Cache.set("test", "key", content)
+    Cache.clear("test")
+    result = Cache.check("test", "key")
+    assert Cache.stats()["test"]["disk_hits"] == 1
+    if isinstance(content, tuple):
+        for r, c in zip(result, content):
+            np.testing.assert_array_equal(r, c)
+    else:
+        np.testing.assert_array_equal(result, content)
@@ -0,0 +1,47 @@
+import numpy as np
+import proxmin
+
+import scarlet
+from scarlet import operator
+
+
+def apply_nested(constraints, shape, X, step):
+    """Apply the operators of all constraints without flattening or fusing them"""
+    prox = proxmin.operators.AlternatingProjections([c.prox_morph(shape) for c in constraints])
+    return prox(X, step)
+
+
+def test_cached_prox_morph():
+    constraints = [scarlet.SimpleConstraint(), scarlet.DirectMonotonicityConstraint(),
+                   scarlet.DirectSymmetryConstraint()]
+    rng = np.random.RandomState(0)
+    component = scarlet.Component(rng.rand(3), rng.rand(15, 15), center=(20, 20), constraints=constraints)
+    prox = component.constraints.prox_morph
+    # the default constraints are fused into a single operator
+    assert operator.can_batch(prox)
+    # the operator is only built once for every shape
+    assert component.constraints.prox_morph is prox
+    X = rng.randn(15, 15)
+    np.testing.assert_allclose(prox(X.copy(), 0.1), apply_nested(constraints, (15, 15), X.copy(), 0.1),
+                               rtol=0, atol=1e-14)
+
+    # resizing the component resets the cached operators
+    component.resize((15, 25))
+    prox = component.constraints.prox_morph
+    X = rng.randn(15, 25)
+    np.testing.assert_allclose(prox(X.copy(), 0.1), apply_nested(constraints, (15, 25), X.copy(), 0.1),
+                               rtol=0, atol=1e-14)
+
+
+def test_cached_prox_morph_chain():
+    # operators that cannot be fused are combined into a flat chain
+    constraints = [scarlet.SimpleConstraint(), scarlet.DirectMonotonicityConstraint(use_nearest=True),
+                   scarlet.L0Constraint(0.1)]
+    rng = np.random.RandomState(1)
+    component = scarlet.Component(rng.rand(3), rng.rand(15, 15), center=(20, 20), constraints=constraints)
+    prox = component.constraints.prox_morph
+    assert isinstance(prox, proxmin.operators.AlternatingProjections)
+    assert len(prox.operators) == 4
+    assert not operator.can_batch(prox)
+    X = rng.randn(15, 15)
+    np.testing.assert_array_equal(prox(X.copy(), 0.1), apply_nested(constraints, (15, 15), X.copy(), 0.1))
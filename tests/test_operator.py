@@ -0,0 +1,141 @@
+import glob
+import importlib.util
+import os
+import shutil
+import subprocess
+import sys
+import sysconfig
+
+import numpy as np
+import proxmin
+import pytest
+from scipy import optimize, sparse
+
+import scarlet
+from scarlet import operator, transformation
+
+
+def nearest_references(shape):
+    monotonicOp = transformation.getRadialMonotonicOp(shape, useNearest=True)
+    x_idx, ref_idx = sparse.find(monotonicOp.L == 1)[:2]
+    return ref_idx[np.argsort(x_idx)]
+
+
+def project_monotonic(X, thresh=0):
+    """Reference solution of the projection with a generic QP solver"""
+    ref_idx = nearest_references(X.shape)
+    x0 = X.reshape(-1)
+    constraints = [{"type": "ineq", "fun": lambda x, i=i, r=r: (1-thresh)*x[r] - x[i]}
+                   for i, r in enumerate(ref_idx) if i != r]
+    result = optimize.minimize(lambda x: 0.5*np.sum((x-x0)**2), x0, jac=lambda x: x-x0,
+                               constraints=constraints, method="SLSQP",
+                               options={"ftol": 1e-14, "maxiter": 1000})
+    assert result.success
+    return result.x.reshape(X.shape)
+
+
+def test_nearest_references():
+    shape = (5, 5)
+    ref_idx = nearest_references(shape)
+    assert len(ref_idx) == 25
+    # the peak is its own reference, all other pixels reference a closer pixel
+    center = 12
+    assert ref_idx[center] == center
+    distance = np.hypot(*np.divmod(np.arange(25), 5) - np.array([[2], [2]]))
+    mask = np.arange(25) != center
+    assert np.all(distance[ref_idx[mask]] < distance[mask])
+
+
+def test_prox_strict_monotonic_nearest():
+    X = np.random.RandomState(0).rand(5, 5)
+    prox = operator.prox_strict_monotonic(X.shape, use_nearest=True)
+    result = prox(X.copy(), 0)
+    ref_idx = nearest_references(X.shape)
+    flat = result.reshape(-1)
+    assert np.all(flat <= flat[ref_idx])
+
+
+@pytest.mark.parametrize("thresh", [0, 0.1])
+def test_prox_exact_monotonic(thresh):
+    rng = np.random.RandomState(1)
+    constraint = scarlet.DirectMonotonicityConstraint(exact=True, thresh=thresh)
+    prox = constraint.prox_morph((5, 5))
+    ref_idx = nearest_references((5, 5))
+    for trial in range(20):
+        X = rng.randn(5, 5)
+        if trial % 2:
+            # tied values
+            X = np.round(X)
+        result = prox(X.copy(), 0)
+        flat = result.reshape(-1)
+        mask = np.arange(25) != 12
+        assert np.all(flat[mask] <= (1-thresh)*flat[ref_idx][mask] + 1e-12)
+        np.testing.assert_allclose(result, project_monotonic(X, thresh), atol=1e-6)
+
+
+def get_default_operator(shape, dtype):
+    """Fused and chained morphology operators of the default constraints"""
+    constraints = [scarlet.SimpleConstraint(), scarlet.DirectMonotonicityConstraint(dtype=dtype),
+                   scarlet.DirectSymmetryConstraint()]
+    ops = []
+    for c in constraints:
+        prox = c.prox_morph(shape)
+        ops += prox.operators if isinstance(prox, proxmin.operators.AlternatingProjections) else [prox]
+    return operator.fuse_morph_operators(ops), proxmin.operators.AlternatingProjections(ops)
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+@pytest.mark.parametrize("shape", [(15, 15), (15, 25)])
+def test_fused_morph_operator(dtype, shape):
+    fused, chain = get_default_operator(shape, dtype)
+    assert fused is not None
+    rng = np.random.RandomState(3)
+    for trial in range(5):
+        X = rng.randn(*shape).astype(dtype)
+        expected = chain(X.copy(), 0.1)
+        result = fused(X.copy(), 0.1)
+        assert result.dtype == dtype
+        np.testing.assert_allclose(result, expected, rtol=0, atol=10*np.finfo(dtype).eps)
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_prox_batch(dtype):
+    fused, chain = get_default_operator((15, 25), dtype)
+    X = np.random.RandomState(4).randn(7, 15, 25).astype(dtype)
+    expected = np.array([fused(x.copy(), 0.1) for x in X])
+    result = operator.prox_batch(fused, X.copy(), 0.1)
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_build_without_openmp(tmpdir):
+    """Build the extension with a compiler that does not support OpenMP"""
+    compiler = sysconfig.get_config_var("CXX")
+    ldshared = sysconfig.get_config_var("LDSHARED")
+    root = os.path.join(os.path.dirname(__file__), "..")
+    if compiler is None or ldshared is None or shutil.which(compiler.split()[0]) is None:
+        pytest.skip("no C++ compiler")
+    wrapper = str(tmpdir.join("cxx"))
+    with open(wrapper, "w") as f:
+        f.write('#!/bin/sh\nfor arg in "$@"; do\n  if [ "$arg" = "-fopenmp" ]; then\n'
+                '    echo "unsupported option -fopenmp" >&2\n    exit 1\n  fi\ndone\n'
+                'exec {0} "$@"\n'.format(compiler))
+    os.chmod(wrapper, 0o755)
+    env = dict(os.environ, CC=wrapper, CXX=wrapper, LDSHARED=" ".join([wrapper] + ldshared.split()[1:]),
+               CFLAGS="-O0")
+    build = subprocess.run([sys.executable, "setup.py", "build_ext", "--build-temp", str(tmpdir.join("temp")),
+                            "--build-lib", str(tmpdir.join("lib"))], cwd=root, env=env,
+                           stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    assert build.returncode == 0, build.stdout.decode()[-2000:]
+
+    filename = glob.glob(str(tmpdir.join("lib", "scarlet", "operators_pybind11*")))[0]
+    spec = importlib.util.spec_from_file_location("operators_pybind11", filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    # the stacked operator is applied serially
+    fused, chain = get_default_operator((15, 15), np.float64)
+    X = np.random.RandomState(5).randn(3, 15, 15)
+    expected = np.array([fused(x.copy(), 0.1) for x in X])
+    kwargs = fused.keywords
+    module.prox_default_morph_stack(X.reshape(3, -1), 0.1, kwargs["weights"], kwargs["offsets"], kwargs["didx"],
+                                    kwargs.get("thresh", 0), kwargs.get("sigma", 1), 7*15+7, kwargs.get("tiny", 1e-10))
+    np.testing.assert_array_equal(X, expected)
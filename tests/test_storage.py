@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+import scarlet
+from scarlet.storage import ParameterStore
+
+
+def get_components(shapes=[(5, 5), (7, 5), (5, 5)], B=3):
+    rng = np.random.RandomState(0)
+    components = []
+    for k, shape in enumerate(shapes):
+        center = (10 + 20*k, 10)
+        components.append(scarlet.Component(rng.rand(B), rng.rand(*shape), center=center))
+    return components
+
+
+def check_views(store):
+    """Every SED and morphology is a view into the store"""
+    for k, c in enumerate(store.components):
+        assert np.shares_memory(c.sed, store.sed[k])
+        n = store.members[c.morph.shape].index(k)
+        assert np.shares_memory(c.morph, store.morphs[c.morph.shape][n])
+    assert sorted(sum(store.members.values(), [])) == list(range(store.K))
+
+
+def test_store():
+    components = get_components()
+    seds = [c.sed.copy() for c in components]
+    morphs = [c.morph.copy() for c in components]
+    store = ParameterStore(components)
+    check_views(store)
+    assert store.members == {(5, 5): [0, 2], (7, 5): [1]}
+    np.testing.assert_array_equal(store.sed, seds)
+    for c, morph in zip(components, morphs):
+        np.testing.assert_array_equal(c.morph, morph)
+
+    # assigning parameters with the same shape copies them into the store
+    c = components[2]
+    version = c.morph_version
+    c.sed = np.ones(3)
+    c.morph = np.ones((5, 5))
+    assert c.morph_version == version + 1
+    check_views(store)
+    np.testing.assert_array_equal(store.sed[2], 1)
+    np.testing.assert_array_equal(store.morphs[(5, 5)][1], 1)
+    with pytest.raises(ValueError):
+        c.sed = np.ones(4)
+
+
+def test_store_resize():
+    components = get_components()
+    morphs = [c.morph.copy() for c in components]
+    store = ParameterStore(components)
+    old_slice, new_slice = components[0].resize((7, 9))
+    assert components[0].morph.shape == (7, 9)
+    # the stacks are rebuilt and all views are updated
+    check_views(store)
+    assert store.members == {(7, 9): [0], (7, 5): [1], (5, 5): [2]}
+    np.testing.assert_array_equal(components[0].morph[new_slice], morphs[0][old_slice])
+    assert components[0].morph.sum() == morphs[0].sum()
+    for c, morph in zip(components[1:], morphs[1:]):
+        np.testing.assert_array_equal(c.morph, morph)
+
+    # the views stay valid after the components are packed again
+    components[1].morph = np.full((5, 5), 2.)
+    check_views(store)
+    assert store.members == {(7, 9): [0], (5, 5): [1, 2]}
+    np.testing.assert_array_equal(store.morphs[(5, 5)][0], 2)
+    store.pack()
+    check_views(store)
+
+
+def test_store_detach():
+    components = get_components()
+    store = ParameterStore(components)
+    stacks = dict(store.morphs)
+    sed = store.sed
+    store.detach()
+    assert store.K == 0
+    for k, c in enumerate(components):
+        assert c._store is None
+        assert not np.shares_memory(c.sed, sed)
+        assert not np.shares_memory(c.morph, stacks[c.morph.shape])
+        np.testing.assert_array_equal(c.sed, sed[k])
+    # new parameters are assigned without copies
+    morph = np.ones((9, 9))
+    components[0].morph = morph
+    assert components[0].morph is morph
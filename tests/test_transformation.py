@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from scarlet import transformation
+
+
+def get_psfs(B=3, size=11):
+    y, x = np.mgrid[:size, :size] - size//2
+    return np.array([np.exp(-(x**2 + y**2)/(2.*(1.+b)**2)) for b in range(B)])
+
+
+@pytest.mark.parametrize("fft", [False, True])
+def test_chain_truncates_at_edges(fft):
+    rng = np.random.RandomState(0)
+    morph = rng.rand(15, 15)
+    gamma = transformation.Gamma(psfs=get_psfs(), fft=fft)([0.3, -0.4])
+    # apply the filters one after the other (the last one first), truncating at the edges
+    expected = np.array([g.filters[0].dot(g.filters[1].dot(morph)) for g in gamma])
+    np.testing.assert_allclose(np.array([g.dot(morph) for g in gamma]), expected, atol=1e-12)
+    np.testing.assert_allclose(transformation.apply_filters(gamma, morph), expected, atol=1e-12)
+
+
+def test_chain_adjoint():
+    rng = np.random.RandomState(1)
+    morph = rng.rand(15, 15)
+    data = rng.rand(3, 15, 15)
+    gamma = transformation.Gamma(psfs=get_psfs())([0.3, -0.4])
+    model = transformation.apply_filters(gamma, morph)
+    gradient = transformation.apply_filters([g.T for g in gamma], data)
+    np.testing.assert_allclose(np.sum(model*data), np.sum(morph[None]*gradient))
+
+
+def test_fused_chain():
+    rng = np.random.RandomState(2)
+    morph = np.zeros((15, 15))
+    morph[3:-3, 3:-3] = rng.rand(9, 9)
+    gamma = transformation.Gamma(psfs=get_psfs(size=5), fuse=True)([0.3, -0.4])
+    expected = np.array([g.filters[0].dot(g.filters[1].dot(morph)) for g in gamma])
+    # without flux at the edges the fused chain is the same
+    np.testing.assert_allclose(transformation.apply_filters(gamma, morph), expected, atol=1e-12)